@@ -1,11 +1,17 @@
 import os
 import sys
+import time
 
 path = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ) )
-sys.path.append( '.' )
-os.chdir( path )
+sys.path.append( path )
 
-from main import launch
-
-if __name__ == '__main__':
-	launch()
+def launch():
+	# a subcommand (`run` ...) starts the headless command line, which never imports Qt
+	if len( sys.argv ) > 1 and not sys.argv[ 1 ].startswith( '-' ):
+		from cli import launch
+		launch()
+	else:
+		started = time.perf_counter()
+		os.chdir( path )
+		from main import launch
+		launch( started )
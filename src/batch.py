@@ -0,0 +1,871 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import json, math
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+import collections
+
+from core import Pool, Budget, Results, Prefetcher, dimensions, memory, cost
+from engines import ENGINES, BatchEngine, transient
+
+# fast non-cryptographic hash for the dedupe, blake2 without it
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+# copy on write clones (linux)
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+FICLONE = 0x40049409
+
+def sync( path ):
+	# on the disk before it is renamed (or recorded): a power loss leaves the previous file or this one, never an empty one
+	fd = os.open( path, ( os.O_RDONLY if os.path.isdir( path ) else os.O_RDWR ) )
+	try:
+		os.fsync( fd )
+	finally:
+		os.close( fd )
+
+def replace( tmp, path ):
+	sync( tmp )
+	os.replace( tmp, path )
+
+	# the rename itself, where folders can be synced (not on Windows)
+	try:
+		sync( os.path.dirname( os.path.abspath( path ) ) )
+	except OSError:
+		pass
+
+def dump( file, data ):
+	# never a half written file: written aside, then renamed over the previous one
+	try:
+		tmp = ( file + '.tmp' )
+		with open( tmp, 'w', encoding = 'utf-8' ) as f:
+			f.write( json.dumps( data ) )
+		replace( tmp, file )
+	except OSError:
+		pass
+
+def rendition( item ):
+	# folder: below the target, size: longest side in pixel (0: as is), format: extension (None: as is),
+	# quality: None for the batch quality, scale: of the watermark (and its position)
+	data = { 'folder': '', 'size': 0, 'format': None, 'quality': None, 'scale': 1. }
+	data.update( item )
+
+	return ( data )
+
+def partial( target ):
+	# same folder (same filesystem for the rename) and same extension (it picks the encoder)
+	name, ext = os.path.splitext( os.path.basename( target ) )
+	return ( os.path.join( os.path.dirname( target ), '.%s.partial%s' % ( name, ext ) ) )
+
+def fingerprint( file ):
+	digest = ( xxhash.xxh3_128() if xxhash else hashlib.blake2b( digest_size = 16 ) )
+	with open( file, 'rb' ) as f:
+		for block in iter( lambda: f.read( 1 << 20 ), b'' ):
+			digest.update( block )
+
+	return ( digest.hexdigest() )
+
+def materialize( source, target, mode = 'reflink' ):
+	# target gets the content of source, as a 'reflink' (clone sharing its blocks), a hard 'link' or a 'copy'
+	# a clone or a link the filesystem refuses falls back on a copy, returns the mode used
+	tmp = partial( target )
+	try:
+		os.remove( tmp )
+	except OSError:
+		pass
+
+	done = None
+	if mode == 'link':
+		try:
+			os.link( source, tmp )
+			done = 'link'
+		except OSError:
+			pass
+	elif mode == 'reflink' and fcntl:
+		try:
+			with open( source, 'rb' ) as src, open( tmp, 'wb' ) as dst:
+				fcntl.ioctl( dst.fileno(), FICLONE, src.fileno() )
+			done = 'reflink'
+		except OSError:
+			pass
+
+	if not done:
+		shutil.copyfile( source, tmp )
+		done = 'copy'
+	replace( tmp, target )
+
+	return ( done )
+
+def ordered( renditions ):
+	# largest first: each rendition is downscaled from the previous one (0, full size, before any other)
+	return ( sorted( ( rendition( item ) for item in ( renditions or [] ) ), key = lambda item: ( item[ 'size' ] == 0, item[ 'size' ] ), reverse = True ) )
+
+def outcome( watermark, engine = 'composite', gravity = 'Center', quality = 100, opacity = 100, position = ( 0, 0 ), size = ( 0, 0 ), maxsize = None, renditions = None, **others ):
+	# the settings the outputs depend on, the others (workers, memory, timeout ...) only change how they are made
+	try:
+		mark = Manifest.digest( watermark )
+	except OSError:
+		mark = None
+
+	return ( {
+		'engine':		engine,
+		'gravity':		gravity,
+		'quality':		quality,
+		'opacity':		opacity,
+		'position':		list( position ),
+		'size':			list( size ),
+		'maxsize':		maxsize,
+		'renditions':	ordered( renditions ),
+		'watermark':	mark
+	} )
+
+class Manifest( object ):
+	name = '.batchSigning.json'
+
+	# durable: kept in the target, otherwise only for the lifetime of the batch (see cluster, its queue keeps what is done)
+	def __init__( self, target, settings, checksum = False, job = None, durable = True ):
+		self.file = ( os.path.join( target, self.name ) if durable else None )
+		self.journal = ( ( self.file + '.journal' ) if durable else None )
+		self.target = target
+		self.checksum = checksum
+		self.job = job
+		self.lock = threading.Lock()
+		self.stream = None
+		self.files = {}
+
+		self.settings = hashlib.sha1( json.dumps( settings, sort_keys = True ).encode( 'utf-8' ) ).hexdigest()
+
+		if not durable:
+			return
+
+		try:
+			with open( self.file, 'r', encoding = 'utf-8' ) as f:
+				self.files = json.loads( f.read() ).get( 'files', {} )
+		except ( OSError, ValueError ):
+			pass
+
+		# what finished since the last save (crash, reboot ...), one JSON line per photo
+		try:
+			with open( self.journal, 'r', encoding = 'utf-8' ) as f:
+				for line in f:
+					try:
+						key, entry = json.loads( line )
+					except ValueError:
+						break
+
+					if entry:
+						self.files[ key ] = entry
+					else:
+						self.files.pop( key, None )
+		except OSError:
+			pass
+
+	def append( self, key, entry ):
+		# under the lock
+		if not self.journal:
+			return
+		if not self.stream:
+			try:
+				self.stream = open( self.journal, 'a', encoding = 'utf-8' )
+			except OSError:
+				return
+
+		# synced: a line the journal keeps after a power loss is a photo whose output is on the disk too
+		self.stream.write( json.dumps( [ key, entry ] ) + '\n' )
+		self.stream.flush()
+		try:
+			os.fsync( self.stream.fileno() )
+		except OSError:
+			pass
+
+	@staticmethod
+	def digest( file ):
+		digest = hashlib.sha1()
+		with open( file, 'rb' ) as f:
+			for block in iter( lambda: f.read( 1 << 20 ), b'' ):
+				digest.update( block )
+
+		return ( digest.hexdigest() )
+
+	def key( self, output ):
+		return ( os.path.relpath( output, self.target ).replace( os.sep, '/' ) )
+
+	# job: only what this job already did counts
+	def uptodate( self, file, output, job = None ):
+		with self.lock:
+			entry = self.files.get( self.key( output ) )
+
+		if not entry or entry[ 'source' ] != os.path.realpath( file ) or entry[ 'settings' ] != self.settings:
+			return ( False )
+		if job and entry.get( 'job' ) != job:
+			return ( False )
+
+		try:
+			stat = os.stat( file )
+			# an empty output is what a crash may leave behind
+			if not os.path.isfile( output ) or not os.path.getsize( output ):
+				return ( False )
+			if stat.st_size == entry[ 'size' ] and stat.st_mtime_ns == entry[ 'mtime' ]:
+				return ( True )
+
+			# touched but maybe not modified (copied back, restored from backup ...)
+			if self.checksum and stat.st_size == entry[ 'size' ] and entry.get( 'hash' ) == self.digest( file ):
+				self.update( file, output, entry[ 'hash' ] )
+				return ( True )
+		except OSError:
+			pass
+
+		return ( False )
+
+	def update( self, file, output, digest = None ):
+		try:
+			stat = os.stat( file )
+			if self.checksum and not digest:
+				digest = self.digest( file )
+		except OSError:
+			return
+
+		entry = {
+			'source':	os.path.realpath( file ),
+			'size':		stat.st_size,
+			'mtime':	stat.st_mtime_ns,
+			'settings':	self.settings
+		}
+		if digest:
+			entry[ 'hash' ] = digest
+		if self.job:
+			entry[ 'job' ] = self.job
+
+		key = self.key( output )
+		with self.lock:
+			self.files[ key ] = entry
+			self.append( key, entry )
+
+	def discard( self, output ):
+		key = self.key( output )
+		with self.lock:
+			if self.files.pop( key, None ):
+				self.append( key, None )
+
+	def save( self ):
+		if not self.file:
+			return
+
+		with self.lock:
+			dump( self.file, { 'version': 1, 'files': self.files } )
+
+			# everything is in the manifest now
+			if self.stream:
+				self.stream.close()
+				self.stream = None
+			try:
+				os.remove( self.journal )
+			except OSError:
+				pass
+
+class Job( object ):
+	# what an interrupted batch needs to be resumed with the same settings, in its target
+	name = '.batchSigning.job.json'
+
+	# folder: None for a batch that is not resumed from its target (see cluster)
+	def __init__( self, folder, id = None, **data ):
+		self.file = ( folder and os.path.join( folder, self.name ) )
+		self.id = ( id or uuid.uuid4().hex )
+		self.data = data
+
+	@classmethod
+	def load( cls, target ):
+		try:
+			with open( os.path.join( target, cls.name ), 'r', encoding = 'utf-8' ) as f:
+				return ( json.loads( f.read() ) )
+		except ( OSError, ValueError ):
+			return ( None )
+
+	def save( self, state ):
+		if not self.file:
+			return
+
+		data = dict( self.data )
+		data.update( { 'version': 1, 'id': self.id, 'state': state } )
+		dump( self.file, data )
+
+class Trace( object ):
+	# one JSON line per photo, appended while the batch runs
+	def __init__( self, file ):
+		self.lock = threading.Lock()
+		self.stream = open( file, 'a', encoding = 'utf-8' )
+
+	def write( self, record ):
+		line = json.dumps( record )
+		with self.lock:
+			self.stream.write( line + '\n' )
+			self.stream.flush()
+
+	def close( self ):
+		with self.lock:
+			self.stream.close()
+
+class Batch( object ):
+	def __init__( self, watermark, target, quality = 100, opacity = 100, gravity = 'Center', position = ( 0, 0 ), size = ( 0, 0 ), workers = None, engine = 'composite', chunk = 64, megapixels = 512, gallery = None, incremental = True, checksum = False, stopevent = None, sigprogress = None, sigcanceled = None, trace = None, job = None, options = None, budget = None, disk = None, scratch = None, maxsize = None, renditions = None, node = None, timeout = None, retries = 2, dedupe = None, prefetch = None, prefetchsize = None, prefetchcache = None ):
+		global ENGINES
+
+		self.target = target
+		self.incremental = incremental
+		self.gallery = gallery
+		self.workers = ( workers or os.cpu_count() or 1 )
+		self.chunk = chunk
+		self.megapixels = megapixels
+		self.stopevent = stopevent
+		self.sigprogress = sigprogress
+		self.sigcanceled = sigcanceled
+
+		self.renditions = ordered( renditions )
+
+		self.engine = ENGINES[ engine ]( watermark, quality, opacity, gravity, position, size )
+		self.engine.maxsize = ( ( maxsize or 0 ) * 1024 )
+		self.engine.timeout = ( timeout or 0 )
+		self.engine.prepare()
+
+		# transient failures (see engines.transient) are tried again, after 1, 2, 4 ... seconds
+		self.retries = max( 0, ( retries or 0 ) )
+		self.backoff = 1.
+
+		# dedupe: identical photos are rendered once, the outputs of the copies made from the first one (see materialize)
+		# size: { digest: original }, a photo is only hashed once another of the same size shows up
+		# digests are kept per ( file, size, mtime ): a photo rewritten during a watch is hashed again
+		self.dedupe = dedupe
+		self.sizes = {}
+		self.digests = {}
+		self.stats = {}
+		self.rendering = set()
+		self.failed = set()
+		self.condition = threading.Condition()
+
+		# budget / disk in MB, by default half of the physical memory (2 GB when unknown)
+		capacity = ( ( budget << 20 ) if budget else ( ( memory() or ( 4 << 30 ) ) // 2 ) )
+		self.budget = Budget( capacity )
+
+		# ImageMagick spills its pixel cache to mapped files, then to disk, instead of going over
+		self.spill = max( ( 16 << 20 ), min( ( 256 << 20 ), ( capacity // 4 ) ) )
+		if self.engine.limited:
+			# each process gets the memory its photo was admitted with (see Engine.limit), the sum stays within the budget
+			disklimit = ( [ '-limit', 'disk', '%dMiB' % disk ] if disk else [] )
+			self.engine.disk = disklimit
+
+			# larger than the whole budget (gigapixel panoramas, scans): a small pixel cache, the rest on disk (in scratch)
+			self.engine.budget = capacity
+			self.engine.spill = [ '-limit', 'memory', '%dMiB' % ( self.spill >> 20 ), '-limit', 'map', '%dMiB' % ( self.spill >> 20 ) ] + disklimit
+			if scratch:
+				self.engine.environment = dict( os.environ, MAGICK_TEMPORARY_PATH = scratch )
+
+		# job: id of the interrupted batch to resume, options: kept with it for the caller (e.g. the scan filters)
+		# node: worker of a distributed batch, the queue replaces the job and the manifest of the target (see cluster)
+		self.node = node
+		self.job = Job( ( None if node else target ), job, watermark = os.path.abspath( watermark ), gallery = ( gallery and os.path.abspath( gallery ) ), target = os.path.abspath( target ), options = ( options or {} ), settings = {
+			'quality':		quality,
+			'opacity':		opacity,
+			'gravity':		gravity,
+			'position':		list( position ),
+			'size':			list( size ),
+			'workers':		workers,
+			'engine':		engine,
+			'chunk':		chunk,
+			'megapixels':	megapixels,
+			'incremental':	incremental,
+			'checksum':		checksum,
+			'budget':		budget,
+			'disk':			disk,
+			'scratch':		scratch,
+			'maxsize':		maxsize,
+			'renditions':	self.renditions,
+			'timeout':		timeout,
+			'retries':		retries,
+			'dedupe':		dedupe,
+			'prefetch':		prefetch,
+			'prefetchsize':	prefetchsize,
+			'prefetchcache':	prefetchcache
+		} )
+
+		# always kept (the journal of what is done), only trusted to skip photos when incremental or resumed
+		self.manifest = Manifest( target, outcome( watermark, engine, gravity, quality, opacity, position, size, maxsize, renditions ), checksum, self.job.id, not node )
+
+		self.trace = ( Trace( trace ) if trace else None )
+
+		# prefetch: photos read ahead of the workers (prefetchsize: at most that many MB, prefetchcache: copied there)
+		self.prefetch = ( prefetch or 0 )
+		self.prefetcher = ( Prefetcher( prefetch, ( ( prefetchsize << 20 ) if prefetchsize else None ), prefetchcache ) if prefetch else None )
+
+		# only once everything above is set up: a batch that could not start is not offered for resuming
+		self.job.save( 'running' )
+
+		self.pool = None
+		self.watcher = None
+		self.closed = False
+		self.lock = threading.Lock()
+		self.done = 0
+		self.total = 0
+		self.results = Results()
+
+	def output( self, file ):
+		# with renditions, the one of the first (the manifest, the trace and the progress follow it)
+		if self.renditions:
+			return ( self.outputs( file )[ 0 ][ 1 ] )
+
+		return ( os.path.join( self.target, ( os.path.relpath( file, self.gallery ) if self.gallery else os.path.basename( file ) ) ) )
+
+	def outputs( self, file ):
+		relative = ( os.path.relpath( file, self.gallery ) if self.gallery else os.path.basename( file ) )
+
+		outputs = []
+		for item in self.renditions:
+			path = os.path.join( self.target, item[ 'folder' ], relative )
+			if item[ 'format' ]:
+				path = ( os.path.splitext( path )[ 0 ] + '.' + item[ 'format' ].lstrip( '.' ) )
+			outputs.append( ( item, path ) )
+
+		return ( outputs )
+
+	def count( self ):
+		with self.lock:
+			index = self.done
+			self.done += 1
+
+		return ( index )
+
+	def record( self, file, target, status, queue = None, phases = None, wall = None, output = '' ):
+		phases = ( phases or {} )
+		size = dimensions( file )
+
+		def length( path ):
+			try:
+				return ( os.path.getsize( path ) )
+			except OSError:
+				return ( None )
+
+		self.trace.write( {
+			'time':			time.time(),
+			'source':		file,
+			'output':		target,
+			'engine':		self.engine.name,
+			'status':		status,
+			'exit':			phases.get( 'exit' ),
+			'queue':		queue,
+			'decode':		phases.get( 'decode' ),
+			'composite':	phases.get( 'composite' ),
+			'encode':		phases.get( 'encode' ),
+			'quality':		phases.get( 'quality' ),
+			'process':		phases.get( 'process' ),
+			'wall':			wall,
+			'input_bytes':	length( file ),
+			'output_bytes':	( length( target ) if status == 'ok' else None ),
+			'width':		( size[ 0 ] if size else None ),
+			'height':		( size[ 1 ] if size else None ),
+			'retries':		phases.get( 'retries', 0 ),
+			'stderr':		( output or '' )
+		} )
+
+	def ignore( self, files, queue = None ):
+		if not files:
+			return
+
+		with self.lock:
+			if self.sigcanceled and not self.results.count( Results.IGNORED ):
+				self.sigcanceled()
+
+			self.results.add( Results.IGNORED, files )
+
+		if self.trace:
+			for file in files:
+				self.record( file, self.output( file ), 'ignored', queue )
+
+	def fingerprint( self, file ):
+		with self.condition:
+			key = ( ( file, ) + self.stats.get( file, () ) )
+			digest = self.digests.get( key )
+		if digest is None:
+			digest = fingerprint( file )
+			with self.condition:
+				self.digests[ key ] = digest
+
+		return ( digest )
+
+	def forget( self, file ):
+		# with the lock held: the size and digest of a photo registered again no longer say anything about its content
+		stat = self.stats.pop( file, None )
+		if stat is None:
+			return
+
+		digests = self.sizes.get( stat[ 0 ], {} )
+		for digest, original in list( digests.items() ):
+			if original == file:
+				del digests[ digest ]
+		self.digests.pop( ( ( file, ) + stat ), None )
+
+	# returns the photo this one is a copy of, None when it is the first of its content (rendering: it will be)
+	def register( self, file, rendering = True ):
+		try:
+			info = os.stat( file )
+		except OSError:
+			return ( None )
+		size = info.st_size
+
+		with self.condition:
+			if self.stats.get( file ) != ( size, info.st_mtime_ns ):
+				self.forget( file )
+				self.stats[ file ] = ( size, info.st_mtime_ns )
+
+			if size not in self.sizes:
+				self.sizes[ size ] = { None: file }
+				if rendering:
+					self.rendering.add( file )
+				return ( None )
+			digests = self.sizes[ size ]
+
+		# hashed out of the lock, by the worker which got the photo
+		try:
+			digest = self.fingerprint( file )
+			first = digests.get( None )
+			if first:
+				first = ( self.fingerprint( first ), first )
+		except OSError:
+			return ( None )
+
+		with self.condition:
+			if first and digests.pop( None, None ):
+				digests.setdefault( *first )
+
+			original = digests.setdefault( digest, file )
+			if original != file:
+				return ( original )
+			if rendering:
+				self.rendering.add( file )
+
+		return ( None )
+
+	def settle( self, files, succeeded ):
+		# the copies waiting for these photos may go on
+		with self.condition:
+			for file in files:
+				self.rendering.discard( file )
+				if file not in succeeded:
+					self.failed.add( file )
+			self.condition.notify_all()
+
+	def duplicate( self, items, queued = None ):
+		sigprogress = self.sigprogress
+		queue = ( ( time.monotonic() - queued ) if queued else None )
+
+		for file, t, original in items:
+			with self.condition:
+				while original in self.rendering:
+					self.condition.wait()
+				failed = ( original in self.failed )
+
+			if ( self.stopevent and self.stopevent.is_set() ) or self.engine.canceled:
+				self.ignore( [ file ], queue )
+				continue
+
+			paths = ( [ ( source, target ) for ( item, source ), ( item, target ) in zip( self.outputs( original ), self.outputs( file ) ) ] if self.renditions else [ ( self.output( original ), t ) ] )
+			cmd = [ self.dedupe, paths[ 0 ][ 0 ], paths[ 0 ][ 1 ] ]
+			error = failed
+			output = ( 'duplicate of %s, which failed' % original if failed else 'duplicate of %s' % original )
+			if not failed:
+				try:
+					for source, target in paths:
+						os.makedirs( os.path.dirname( target ), exist_ok = True )
+						materialize( source, target, self.dedupe )
+				except OSError as e:
+					error = True
+					output = str( e )
+
+			if self.trace:
+				self.record( file, t, ( 'error' if error else 'duplicate' ), queue, None, None, output )
+
+			if error:
+				self.manifest.discard( t )
+			else:
+				self.manifest.update( file, t )
+
+			self.results.add( ( Results.ERRORS if error else Results.SUCCESS ), [ file ], [ output ], duplicate = not error )
+			index = self.count()
+			if sigprogress:
+				sigprogress( index, self.total, file, cmd, error, output )
+
+	def run( self, files, queued = None ):
+		try:
+			self.handle( files, queued )
+		finally:
+			if self.prefetcher:
+				self.prefetcher.release( files )
+
+	def handle( self, files, queued = None ):
+		sigprogress = self.sigprogress
+		started = time.monotonic()
+		queue = ( ( started - queued ) if queued else None )
+
+		if self.stopevent and self.stopevent.is_set():
+			self.ignore( files, queue )
+			return
+
+		items = []
+		for file in files:
+			t = self.output( file )
+			if not self.manifest.uptodate( file, t, ( None if self.incremental else self.job.id ) ) or not all( os.path.isfile( path ) for item, path in self.outputs( file ) ):
+				items.append( ( file, t ) )
+				continue
+
+			self.results.add( Results.SKIPPED, [ file ], [ 'up to date' ] )
+			if self.dedupe:
+				self.register( file, False )
+			if self.trace:
+				self.record( file, t, 'skipped', queue )
+
+			index = self.count()
+			if sigprogress:
+				sigprogress( index, self.total, file, None, False, 'up to date' )
+
+		# copies of a photo already seen are made once it is rendered, the workers hash the photos they got
+		duplicates = []
+		if self.dedupe:
+			originals = []
+			for file, t in items:
+				original = self.register( file )
+				if original:
+					duplicates.append( ( file, t, original ) )
+				else:
+					originals.append( ( file, t ) )
+			items = originals
+
+		succeeded = []
+		try:
+			if items:
+				self.admit( items, queued, succeeded )
+		finally:
+			if self.dedupe:
+				self.settle( [ file for file, t in items ], succeeded )
+
+		if duplicates:
+			self.duplicate( duplicates, queued )
+
+	def admit( self, items, queued, succeeded ):
+		queue = ( ( time.monotonic() - queued ) if queued else None )
+
+		# waits for enough memory: many small photos run at once, huge ones a few at a time (a chunk holds one photo at a time)
+		size = max( cost( file ) for file, t in items )
+		if self.engine.spill and size > self.budget.capacity:
+			size = ( self.spill + ( 32 << 20 ) )
+		if not self.budget.acquire( size, self.stopevent ):
+			self.ignore( [ file for file, t in items ], queue )
+			return
+
+		try:
+			succeeded.extend( self.render( items, queued ) )
+		finally:
+			self.budget.release( size )
+
+	def render( self, items, queued = None ):
+		sigprogress = self.sigprogress
+		started = time.monotonic()
+		queue = ( ( started - queued ) if queued else None )
+
+		if sigprogress:
+			sigprogress( self.done, self.total, items[ 0 ][ 0 ], None, None, None )
+
+		# every output of each photo
+		targets = [ ( [ path for item, path in self.outputs( file ) ] if self.renditions else [ t ] ) for file, t in items ]
+
+		# mirrors the gallery layout
+		for folder in set( os.path.dirname( path ) for paths in targets for path in paths ):
+			try:
+				os.makedirs( folder, exist_ok = True )
+			except OSError:
+				pass
+
+		# rendered aside and renamed once complete: a killed run never leaves a truncated photo behind
+		phases = [ {} for item in items ]
+		results = self.attempt( items, phases )
+
+		# only what failed because of the storage is tried again, a photo that does not decode fails at once
+		for retry in range( self.retries ):
+			again = [ index for index, ( error, output, cmd ) in enumerate( results ) if error and transient( output ) ]
+			if not again or self.engine.canceled:
+				break
+			if self.stopevent and self.stopevent.wait( self.backoff * ( 2 ** retry ) ):
+				break
+			elif not self.stopevent:
+				time.sleep( self.backoff * ( 2 ** retry ) )
+
+			for index, result in zip( again, self.attempt( [ items[ index ] for index in again ], [ phases[ index ] for index in again ] ) ):
+				results[ index ] = result
+				phases[ index ][ 'retries' ] = ( retry + 1 )
+		wall = ( ( time.monotonic() - started ) / len( items ) )
+
+		canceled = []
+		succeeded = []
+		for ( file, t ), paths, ( error, output, cmd ), timings in zip( items, targets, results, phases ):
+			if not error:
+				try:
+					for path in paths:
+						replace( partial( path ), path )
+				except OSError as e:
+					error = True
+					output = str( e )
+			if error:
+				for path in paths:
+					try:
+						os.remove( partial( path ) )
+					except OSError:
+						pass
+
+				if self.engine.canceled:
+					canceled.append( file )
+					continue
+
+			if self.trace:
+				self.record( file, t, ( 'error' if error else 'ok' ), queue, timings, wall, output )
+
+			if error:
+				self.manifest.discard( t )
+			else:
+				self.manifest.update( file, t )
+				succeeded.append( file )
+
+			self.results.add( ( Results.ERRORS if error else Results.SUCCESS ), [ file ], [ output ] )
+			index = self.count()
+			if sigprogress:
+				sigprogress( index, self.total, file, cmd, error, output )
+
+		# killed while in progress: ignored, not failed
+		if canceled:
+			self.ignore( canceled, queue )
+
+		return ( succeeded )
+
+	def source( self, file ):
+		# what the engine reads: the prefetched copy, if any
+		return ( self.prefetcher.path( file ) if self.prefetcher else file )
+
+	def attempt( self, items, phases ):
+		if self.renditions:
+			return ( [ self.engine.renditions( self.source( file ), [ ( item, partial( path ) ) for item, path in self.outputs( file ) ], timings ) for ( file, t ), timings in zip( items, phases ) ] )
+
+		return ( self.engine.batch( [ ( self.source( file ), partial( t ) ) for file, t in items ], phases ) )
+
+	def start( self, workers = None ):
+		self.pool = Pool( min( self.workers, ( workers or self.workers ) ) )
+
+		if self.stopevent:
+			self.watcher = threading.Thread( target = self.watchdog, daemon = True )
+			self.watcher.start()
+
+	def watchdog( self ):
+		# a cancel does not wait for the photos in progress
+		while not self.closed:
+			if self.stopevent.wait( .1 ):
+				self.cancel()
+				return
+
+	def cancel( self ):
+		# the photos in progress are killed, all the queued ones ignored at once
+		self.engine.cancel()
+		if self.pool:
+			self.ignore( [ file for callback, args in self.pool.clear() for file in args[ 0 ] ] )
+
+	def ahead( self, files ):
+		# the prefetcher gets each photo of a generator `prefetch` photos before the workers do
+		window = collections.deque()
+		for file in files:
+			self.prefetcher.add( [ file ] )
+			window.append( file )
+			if len( window ) > self.prefetch:
+				yield ( window.popleft() )
+		while window:
+			yield ( window.popleft() )
+
+	# files may be a generator (see core.scan), the total then grows while it is consumed
+	def feed( self, files ):
+		if not self.pool:
+			self.start()
+
+		sized = hasattr( files, '__len__' )
+		chunk = self.chunk
+		if sized:
+			with self.lock:
+				self.total += len( files )
+			chunk = max( 1, min( chunk, math.ceil( len( files ) / self.pool.workers ) ) )
+
+		# the prefetcher runs ahead of the workers, by its own bounds
+		if self.prefetcher:
+			if sized:
+				self.prefetcher.add( files )
+			else:
+				files = self.ahead( files )
+
+		# each file (or chunk of files for the batch engine) is handed to the first idle worker
+		pending = []
+		pixels = 0
+		for index, file in enumerate( files ):
+			# canceled: what is left of a list is ignored, a scan is not walked any further
+			if self.stopevent and self.stopevent.is_set():
+				self.ignore( pending + ( list( files[ index: ] ) if sized else [] ) )
+				return
+
+			if not sized:
+				with self.lock:
+					self.total += 1
+
+			if self.engine.name != BatchEngine.name:
+				self.pool.submit( self.run, [ file ], time.monotonic() )
+				continue
+
+			size = dimensions( file )
+			pixels += ( ( size[ 0 ] * size[ 1 ] ) if size else 0 )
+			pending.append( file )
+			if len( pending ) >= chunk or pixels >= ( self.megapixels * 1000000 ):
+				self.pool.submit( self.run, pending, time.monotonic() )
+				pending = []
+				pixels = 0
+		if pending:
+			self.pool.submit( self.run, pending, time.monotonic() )
+
+	def save( self ):
+		self.manifest.save()
+
+	def close( self ):
+		if self.pool:
+			self.pool.close()
+		self.closed = True
+		if self.watcher:
+			self.watcher.join()
+		if self.prefetcher:
+			self.prefetcher.close()
+		self.engine.close()
+		self.save()
+
+		self.job.save( 'canceled' if ( self.stopevent and self.stopevent.is_set() ) else 'finished' )
+
+		if self.trace:
+			self.trace.close()
+
+def process( files, watermark, target, quality = 100, opacity = 100, gravity = 'Center', position = ( 0, 0 ), size = ( 0, 0 ), workers = None, engine = 'composite', chunk = 64, megapixels = 512, gallery = None, incremental = True, checksum = False, stopevent = None, sigprogress = None, sigcanceled = None, sigfinished = None, trace = None, job = None, options = None, budget = None, disk = None, scratch = None, maxsize = None, renditions = None, timeout = None, retries = 2, dedupe = None, prefetch = None, prefetchsize = None, prefetchcache = None ):
+	batch = Batch( watermark, target, quality, opacity, gravity, position, size, workers, engine, chunk, megapixels, gallery, incremental, checksum, stopevent, sigprogress, sigcanceled, trace, job, options, budget, disk, scratch, maxsize, renditions, None, timeout, retries, dedupe, prefetch, prefetchsize, prefetchcache )
+
+	if hasattr( files, '__len__' ):
+		batch.start( max( 1, len( files ) ) )
+	batch.feed( files )
+	batch.close()
+
+	if sigfinished:
+		sigfinished( ( stopevent and stopevent.is_set() ), *batch.results )
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import sys
+import math
+import time
+import zlib
+import struct
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+# local
+from core import EXTENSIONS, os_name, startupinfo, resource, scan, dimensions
+from batch import process
+
+# peak memory, unix only
+try:
+	import resource as rusage
+except ImportError:
+	rusage = None
+
+# the metrics compared with a baseline: ( key, True when higher is better )
+METRICS = [ ( 'files_per_second', True ), ( 'megapixels_per_second', True ), ( 'p95', False ), ( 'peak_rss', False ) ]
+
+def png( file, width, height, seed = 0 ):
+	# deterministic gradient + pattern, written without any image library
+	row = bytearray( width * 3 )
+	for x in range( width ):
+		row[ x * 3 ] = ( x * 255 // max( 1, width - 1 ) )
+		row[ x * 3 + 1 ] = ( ( x * 7 + seed * 13 ) & 255 )
+		row[ x * 3 + 2 ] = ( ( x * x + seed ) & 255 )
+	row = bytes( row )
+
+	data = bytearray()
+	for y in range( height ):
+		shift = ( ( y * 3 + seed * 3 ) % len( row ) )
+		data += b'\0'
+		data += row[ shift: ]
+		data += row[ :shift ]
+
+	def chunk( name, body ):
+		return ( struct.pack( '>I', len( body ) ) + name + body + struct.pack( '>I', zlib.crc32( name + body ) & 0xffffffff ) )
+
+	with open( file, 'wb' ) as f:
+		f.write( b'\x89PNG\r\n\x1a\n' )
+		f.write( chunk( b'IHDR', struct.pack( '>IIBBBBB', width, height, 8, 2, 0, 0, 0 ) ) )
+		f.write( chunk( b'IDAT', zlib.compress( bytes( data ), 1 ) ) )
+		f.write( chunk( b'IEND', b'' ) )
+
+def gallery( folder, files = 50, formats = None, resolutions = None, seed = 0 ):
+	global EXTENSIONS, os_name, startupinfo
+
+	# every format is converted from a generated png by the bundled composite
+	composite = resource( 'bin', os_name, 'composite', bin = True )
+	formats = ( formats or EXTENSIONS )
+	resolutions = ( resolutions or [ ( 3000, 2000 ) ] )
+
+	os.makedirs( folder, exist_ok = True )
+	for index in range( files ):
+		ext = formats[ index % len( formats ) ]
+		width, height = resolutions[ index % len( resolutions ) ]
+		file = os.path.join( folder, '%05d.%s' % ( index, ext ) )
+		if os.path.isfile( file ):
+			continue
+
+		if ext == 'png':
+			png( file, width, height, seed + index )
+			continue
+
+		tmp = ( file + '.png' )
+		png( tmp, width, height, seed + index )
+		try:
+			subprocess.check_output( [ composite, '-compose', 'Src', '-quality', '90', tmp, tmp, file ], stdin = subprocess.PIPE, stderr = subprocess.STDOUT, env = os.environ, startupinfo = startupinfo )
+		finally:
+			os.remove( tmp )
+
+	return ( folder )
+
+def percentile( values, p ):
+	# nearest rank
+	if not values:
+		return ( None )
+
+	values = sorted( values )
+	return ( values[ max( 0, min( len( values ) - 1, math.ceil( p / 100. * len( values ) ) - 1 ) ) ] )
+
+def peak( who ):
+	# bytes, ru_maxrss is in kilobytes on linux and in bytes on macos
+	if not rusage:
+		return ( None )
+
+	value = rusage.getrusage( who ).ru_maxrss
+	return ( value if os_name == 'darwin' else ( value * 1024 ) )
+
+def measure( folder, watermark, engine, workers, chunk = 64 ):
+	files = sorted( scan( folder ) )
+	megapixels = 0
+	for file in files:
+		size = dimensions( file )
+		megapixels += ( ( size[ 0 ] * size[ 1 ] / 1000000. ) if size else 0 )
+
+	# per file latency, from the start of its run to its result (a whole chunk with the batch engine)
+	lock = threading.Lock()
+	started = {}
+	latencies = []
+	failures = []
+	def sigprogress( index, total, file, cmd, error, output ):
+		now = time.perf_counter()
+		with lock:
+			if error is None:
+				started[ threading.get_ident() ] = now
+			elif cmd is not None:
+				latencies.append( now - started.get( threading.get_ident(), now ) )
+			if error:
+				failures.append( ( output or '' ).strip().split( '\n' )[ 0 ] )
+
+	result = {}
+	def sigfinished( canceled, success, errors, ignored, skipped ):
+		result.update( { 'success': len( success ), 'errors': len( errors ) } )
+
+	target = tempfile.mkdtemp( prefix = 'batchSigning-bench-' )
+	try:
+		begin = time.perf_counter()
+		process( files, watermark, target, workers = workers, engine = engine, chunk = chunk, gallery = folder, incremental = False, sigprogress = sigprogress, sigfinished = sigfinished )
+		seconds = ( time.perf_counter() - begin )
+
+		output = 0
+		for file in scan( target ):
+			output += os.path.getsize( file )
+	finally:
+		shutil.rmtree( target, True )
+
+	# a run with failed photos measures the failures: not a result, never compared with the baseline
+	errors = result.get( 'errors', len( files ) )
+	if errors:
+		return ( { 'engine': engine, 'workers': workers, 'errors': errors, 'error': '%d of %d photos failed%s' % ( errors, len( files ), ( ': %s' % failures[ 0 ] if failures else '' ) ) } )
+
+	return ( {
+		'engine':					engine,
+		'workers':					workers,
+		'files':					len( files ),
+		'errors':					0,
+		'seconds':					round( seconds, 4 ),
+		'files_per_second':			round( len( files ) / seconds, 3 ),
+		'megapixels_per_second':	round( megapixels / seconds, 3 ),
+		'p50':						round( percentile( latencies, 50 ) * 1000, 2 ) if latencies else None,
+		'p95':						round( percentile( latencies, 95 ) * 1000, 2 ) if latencies else None,
+		'p99':						round( percentile( latencies, 99 ) * 1000, 2 ) if latencies else None,
+		'peak_rss':					peak( rusage.RUSAGE_SELF ) if rusage else None,
+		'peak_rss_children':		peak( rusage.RUSAGE_CHILDREN ) if rusage else None,
+		'output_bytes':				output
+	} )
+
+def child( connection, *args ):
+	try:
+		connection.send( measure( *args ) )
+	except Exception as e:
+		connection.send( { 'error': '%s: %s' % ( type( e ).__name__, e ) } )
+	finally:
+		connection.close()
+
+def isolated( *args ):
+	# one process per run, so that the peak memory of a run is its own
+	methods = multiprocessing.get_all_start_methods()
+	context = multiprocessing.get_context( 'fork' if 'fork' in methods else 'spawn' )
+
+	receiver, sender = context.Pipe( False )
+	worker = context.Process( target = child, args = ( sender, ) + args )
+	worker.start()
+	sender.close()
+	try:
+		result = receiver.recv()
+	except EOFError:
+		result = { 'error': 'exit code %s' % worker.exitcode }
+	worker.join()
+
+	return ( result )
+
+def compare( results, baseline, threshold = .1 ):
+	global METRICS
+
+	# a regression is a metric worse than the baseline by more than `threshold` (relative)
+	previous = {}
+	for item in baseline.get( 'results', [] ):
+		previous[ ( item.get( 'engine' ), item.get( 'workers' ) ) ] = item
+
+	regressions = []
+	for item in results:
+		before = previous.get( ( item.get( 'engine' ), item.get( 'workers' ) ) )
+		if not before:
+			continue
+
+		for key, higher in METRICS:
+			old, new = before.get( key ), item.get( key )
+			if not old or new is None:
+				continue
+
+			change = ( ( new - old ) / old )
+			if ( -change if higher else change ) > threshold:
+				regressions.append( { 'engine': item[ 'engine' ], 'workers': item[ 'workers' ], 'metric': key, 'baseline': old, 'value': new, 'change': round( change, 4 ) } )
+
+	return ( regressions )
+
+def bench( watermark = None, folder = None, files = 50, formats = None, resolutions = None, engines = None, workers = None, chunk = 64, repeat = 1, seed = 0, baseline = None, threshold = .1, sigresult = None ):
+	watermark = ( watermark or resource( 'signature.png' ) )
+	engines = ( engines or [ 'composite', 'batch', 'qt' ] )
+	workers = ( workers or sorted( set( [ 1, ( os.cpu_count() or 1 ) ] ) ) )
+
+	tmp = None
+	if not folder:
+		tmp = folder = tempfile.mkdtemp( prefix = 'batchSigning-gallery-' )
+
+	try:
+		gallery( folder, files, formats, resolutions, seed )
+
+		results = []
+		for engine in engines:
+			for count in workers:
+				# the median run of each configuration is kept
+				runs = [ isolated( folder, watermark, engine, count, chunk ) for index in range( max( 1, repeat ) ) ]
+				failed = [ run for run in runs if 'error' in run ]
+				if failed:
+					result = { 'engine': engine, 'workers': count, 'error': failed[ 0 ][ 'error' ] }
+				else:
+					result = sorted( runs, key = lambda run: run[ 'seconds' ] )[ len( runs ) // 2 ]
+
+				results.append( result )
+				if sigresult:
+					sigresult( result )
+	finally:
+		if tmp:
+			shutil.rmtree( tmp, True )
+
+	report = {
+		'version':	1,
+		'settings':	{
+			'files':		files,
+			'formats':		( formats or EXTENSIONS ),
+			'resolutions':	[ list( item ) for item in ( resolutions or [ ( 3000, 2000 ) ] ) ],
+			'chunk':		chunk,
+			'repeat':		repeat,
+			'seed':			seed
+		},
+		'system':	{
+			'platform':		platform.platform(),
+			'python':		platform.python_version(),
+			'cpus':			os.cpu_count()
+		},
+		'results':	results
+	}
+
+	if baseline is not None:
+		report[ 'regressions' ] = compare( results, baseline, threshold )
+
+	return ( report )
+
+if __name__ == '__main__':
+	from cli import launch
+	launch( [ 'bench' ] + sys.argv[ 1: ] )
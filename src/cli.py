@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+# local
+from core import GRAVITIES, EXTENSIONS, Results, scan
+from engines import ENGINES
+from batch import process
+
+def gravity( value ):
+	global GRAVITIES
+
+	for item in GRAVITIES:
+		if item.lower() == value.lower():
+			return ( item )
+
+	raise argparse.ArgumentTypeError( 'expected one of: %s' % ', '.join( GRAVITIES ) )
+
+def items( kind ):
+	def items( value ):
+		try:
+			return ( [ kind( item.strip() ) for item in value.split( ',' ) if item.strip() ] )
+		except ValueError as e:
+			raise argparse.ArgumentTypeError( str( e ) )
+
+	return ( items )
+
+def resolution( value ):
+	width, height = value.lower().split( 'x' )
+	return ( ( int( width ), int( height ) ) )
+
+def rendition( value ):
+	# FOLDER:SIZE[:FORMAT[:QUALITY[:SCALE]]], empty fields keep their default
+	parts = value.split( ':' )
+	if len( parts ) < 2 or len( parts ) > 5:
+		raise argparse.ArgumentTypeError( 'expected FOLDER:SIZE[:FORMAT[:QUALITY[:SCALE]]]' )
+
+	parts += [ '' ] * ( 5 - len( parts ) )
+	try:
+		return ( {
+			'folder':	parts[ 0 ],
+			'size':		int( parts[ 1 ] or 0 ),
+			'format':	( parts[ 2 ].lower() or None ),
+			'quality':	( int( parts[ 3 ] ) if parts[ 3 ] else None ),
+			'scale':	float( parts[ 4 ] or 1 )
+		} )
+	except ValueError as e:
+		raise argparse.ArgumentTypeError( str( e ) )
+
+def parser():
+	parser = argparse.ArgumentParser( prog = 'batchSigning', description = 'Add a watermark on your photos, without the interface.' )
+	commands = parser.add_subparsers( dest = 'command' )
+	commands.required = True
+
+	run = commands.add_parser( 'run', help = 'watermark every photo of a gallery' )
+	watch = commands.add_parser( 'watch', help = 'watermark new or changed photos as they land in a gallery, until interrupted' )
+	enqueue = commands.add_parser( 'enqueue', help = 'queue the photos of a gallery for workers on any number of machines' )
+	for command in [ run, watch, enqueue ]:
+		command.add_argument( 'watermark', help = 'watermark image' )
+		command.add_argument( 'gallery', help = 'folder containing the photos' )
+		command.add_argument( 'target', help = 'folder receiving the watermarked photos' )
+		command.add_argument( '--gravity', type = gravity, default = 'Center', help = 'watermark anchor (default: Center)' )
+		command.add_argument( '--quality', type = int, default = 100, help = '1 to 100 (default: 100)' )
+		command.add_argument( '--max-size', dest = 'maxsize', type = int, default = None, metavar = 'KB', help = 'jpeg and webp: highest quality (up to --quality) whose output fits in this size' )
+		command.add_argument( '--rendition', dest = 'renditions', type = rendition, action = 'append', metavar = 'FOLDER:SIZE[:FORMAT[:QUALITY[:SCALE]]]', help = 'one output per rendition from a single decode, SIZE is the longest side (0: as is), SCALE that of the watermark (repeatable)' )
+		command.add_argument( '--opacity', type = int, default = 100, help = '1 to 100 (default: 100)' )
+		command.add_argument( '--position', type = int, nargs = 2, default = [ 0, 0 ], metavar = ( 'X', 'Y' ), help = 'offset in pixel from the anchor' )
+		command.add_argument( '--size', type = int, nargs = 2, default = [ 0, 0 ], metavar = ( 'WIDTH', 'HEIGHT' ), help = 'resize the watermark' )
+		command.add_argument( '--depth', type = int, default = None, help = 'sub-folder levels to walk, 0 for the top level only (default: all)' )
+		command.add_argument( '--include', action = 'append', metavar = 'GLOB', help = 'only photos matching this pattern (repeatable)' )
+		command.add_argument( '--exclude', action = 'append', metavar = 'GLOB', help = 'skip files and folders matching this pattern (repeatable)' )
+		command.add_argument( '--workers', type = int, default = None, help = 'parallel workers (default: CPU count)' )
+		command.add_argument( '--engine', choices = sorted( ENGINES.keys() ), default = 'composite', help = 'rendering backend (default: composite)' )
+		command.add_argument( '--chunk', type = int, default = 64, help = 'photos per process with the batch engine (default: 64)' )
+		command.add_argument( '--megapixels', type = int, default = 512, help = 'megapixels per process with the batch engine, a chunk ends at the first limit reached (default: 512)' )
+		command.add_argument( '--timeout', type = float, default = None, metavar = 'SECONDS', help = 'kill and fail a photo taking longer than this, ImageMagick engines only (default: none)' )
+		command.add_argument( '--retries', type = int, default = 2, help = 'attempts again on transient I/O errors, with a growing delay (default: 2)' )
+		command.add_argument( '--dedupe', nargs = '?', const = 'reflink', default = None, choices = [ 'reflink', 'link', 'copy' ], help = 'render identical photos once, the outputs of the copies are reflinks (default), hard links or copies of the first one' )
+		command.add_argument( '--prefetch', type = int, default = None, metavar = 'FILES', help = 'read this many photos ahead of the workers, for galleries on slow or network storage (default: off)' )
+		command.add_argument( '--prefetch-size', dest = 'prefetchsize', type = int, default = None, metavar = 'MB', help = 'at most this much read ahead (default: no limit but --prefetch)' )
+		command.add_argument( '--prefetch-cache', dest = 'prefetchcache', default = None, metavar = 'FOLDER', help = 'copy the photos read ahead into this local folder, rather than warming the page cache' )
+		command.add_argument( '--checksum', action = 'store_true', help = 'compare contents when a photo was touched' )
+		command.add_argument( '--memory', dest = 'budget', type = int, default = None, metavar = 'MB', help = 'memory the photos in progress may take, fewer run at once when they are large (default: half of the RAM)' )
+		command.add_argument( '--scratch', default = None, metavar = 'FOLDER', help = 'where ImageMagick spills the pixel cache of photos larger than --memory (default: the temporary folder)' )
+		command.add_argument( '--disk', type = int, default = None, metavar = 'MB', help = 'disk ImageMagick may use for its pixel cache once over the memory (default: unlimited)' )
+		command.add_argument( '--json', action = 'store_true', help = 'print progress as JSON lines' )
+		if command is not enqueue:
+			command.add_argument( '--trace', default = None, metavar = 'FILE', help = 'append one JSON line per photo (timings, bytes, dimensions, stderr) to this file' )
+
+	run.add_argument( '--all', dest = 'incremental', action = 'store_false', help = 'also redo photos already up to date' )
+	enqueue.add_argument( '--all', dest = 'incremental', action = 'store_false', help = 'also queue photos already done' )
+	enqueue.add_argument( '--lease', type = float, default = 60., metavar = 'SECONDS', help = 'a photo claimed by a worker that stops renewing it goes back to the queue after this (default: 60)' )
+	watch.add_argument( '--settle', type = float, default = 2., help = 'seconds a file must stay unchanged before it is processed (default: 2)' )
+	watch.add_argument( '--interval', type = float, default = 1., help = 'seconds between two checks (default: 1)' )
+	watch.add_argument( '--polling', action = 'store_true', help = 'poll the gallery even where inotify is available' )
+
+	resume = commands.add_parser( 'resume', help = 'go on with the interrupted batch of a target folder, with its settings' )
+	resume.add_argument( 'target', help = 'folder receiving the watermarked photos' )
+	resume.add_argument( '--json', action = 'store_true', help = 'print progress as JSON lines' )
+	resume.add_argument( '--trace', default = None, metavar = 'FILE', help = 'append one JSON line per photo (timings, bytes, dimensions, stderr) to this file' )
+
+	worker = commands.add_parser( 'worker', help = 'process photos queued in a target folder (by enqueue) until there are none left' )
+	worker.add_argument( 'target', help = 'folder receiving the watermarked photos, holding the queue' )
+	worker.add_argument( '--name', default = None, help = 'worker name in the queue (default: host:pid)' )
+	worker.add_argument( '--workers', type = int, default = None, help = 'parallel workers on this machine (default: as queued, else CPU count)' )
+	worker.add_argument( '--memory', dest = 'budget', type = int, default = None, metavar = 'MB', help = 'memory the photos in progress may take on this machine (default: as queued)' )
+	worker.add_argument( '--scratch', default = None, metavar = 'FOLDER', help = 'where ImageMagick spills the pixel cache on this machine (default: as queued)' )
+	worker.add_argument( '--disk', type = int, default = None, metavar = 'MB', help = 'disk ImageMagick may use on this machine (default: as queued)' )
+	worker.add_argument( '--json', action = 'store_true', help = 'print progress as JSON lines' )
+	worker.add_argument( '--trace', default = None, metavar = 'FILE', help = 'append one JSON line per photo (timings, bytes, dimensions, stderr) to this file' )
+
+	bench = commands.add_parser( 'bench', help = 'measure the throughput of each engine on a synthetic gallery' )
+	bench.add_argument( '--watermark', default = None, help = 'watermark image (default: the bundled signature)' )
+	bench.add_argument( '--gallery', default = None, help = 'keep the generated gallery in this folder, reused by later runs' )
+	bench.add_argument( '--files', type = int, default = 50, help = 'photos in the gallery (default: 50)' )
+	bench.add_argument( '--formats', type = items( str ), default = None, metavar = 'LIST', help = 'comma separated formats, cycled over the photos (default: %s)' % ','.join( EXTENSIONS ) )
+	bench.add_argument( '--resolutions', type = items( resolution ), default = None, metavar = 'LIST', help = 'comma separated WIDTHxHEIGHT, cycled over the photos (default: 3000x2000)' )
+	bench.add_argument( '--engines', type = items( str ), default = None, metavar = 'LIST', help = 'comma separated engines (default: composite,batch,qt)' )
+	bench.add_argument( '--workers', type = items( int ), default = None, metavar = 'LIST', help = 'comma separated concurrency levels (default: 1 and the CPU count)' )
+	bench.add_argument( '--chunk', type = int, default = 64, help = 'photos per process with the batch engine (default: 64)' )
+	bench.add_argument( '--repeat', type = int, default = 1, help = 'runs per configuration, the median one is kept (default: 1)' )
+	bench.add_argument( '--seed', type = int, default = 0, help = 'seed of the generated photos (default: 0)' )
+	bench.add_argument( '--output', default = None, metavar = 'FILE', help = 'also write the JSON report to this file (a later --baseline)' )
+	bench.add_argument( '--baseline', default = None, metavar = 'FILE', help = 'flag the regressions against a previous report' )
+	bench.add_argument( '--threshold', type = float, default = .1, help = 'relative change counted as a regression (default: 0.1)' )
+
+	return ( parser )
+
+def report( args, line ):
+	if args.json:
+		line = json.dumps( line )
+	else:
+		status = line[ 'status' ]
+		output = ( line[ 'output' ] or '' ).strip()
+
+		details = ''
+		if status == 'error' and output:
+			details = ( '\n' + output )
+		elif status == 'ok' and output:
+			details = ( ' (%s)' % output )	# e.g. the quality chosen for --max-size
+
+		line = '[%s/%d] %-7s %s%s' % (
+			str( line[ 'index' ] + 1 ).rjust( len( str( line[ 'total' ] ) ) ),
+			line[ 'total' ],
+			status,
+			line[ 'file' ],
+			details
+		)
+
+	sys.stdout.write( line + '\n' )
+	sys.stdout.flush()
+
+def settings( args ):
+	return ( {
+		'quality':		args.quality,
+		'opacity':		args.opacity,
+		'gravity':		args.gravity,
+		'position':		tuple( args.position ),
+		'size':			tuple( args.size ),
+		'workers':		args.workers,
+		'engine':		args.engine,
+		'chunk':		args.chunk,
+		'megapixels':	args.megapixels,
+		'checksum':		args.checksum,
+		'maxsize':		args.maxsize,
+		'renditions':	args.renditions,
+		'timeout':		args.timeout,
+		'retries':		args.retries,
+		'dedupe':		args.dedupe,
+		'prefetch':		args.prefetch,
+		'prefetchsize':	args.prefetchsize,
+		'prefetchcache':	args.prefetchcache,
+		'budget':		args.budget,
+		'disk':			args.disk,
+		'scratch':		args.scratch,
+		'trace':		getattr( args, 'trace', None )
+	} )
+
+def check( args ):
+	for path in [ args.watermark, args.gallery ]:
+		if not os.path.exists( path ):
+			sys.stderr.write( 'batchSigning: no such file or directory: %s\n' % path )
+			return ( False )
+	if not os.path.isdir( args.target ):
+		os.makedirs( args.target )
+
+	return ( True )
+
+def progress( args ):
+	def progress( index, total, file, cmd, error, output ):
+		if error is None:
+			return
+
+		status = ( 'error' if error else ( 'skipped' if cmd is None else 'ok' ) )
+		report( args, { 'event': 'file', 'index': index, 'total': total, 'file': file, 'status': status, 'output': ( output or '' ) } )
+
+	return ( progress )
+
+def summary( args, result ):
+	if args.json:
+		sys.stdout.write( json.dumps( result ) + '\n' )
+	else:
+		duplicates = ( ' (%d duplicates)' % result[ 'duplicates' ] if result.get( 'duplicates' ) else '' )
+		sys.stdout.write( ( '%(success)d done' + duplicates + ', %(skipped)d up to date, %(errors)d errors, %(ignored)d ignored\n' ) % result )
+
+def wait( thread, stopevent ):
+	# in a thread, so that Ctrl+C only cancels the remaining photos (sleep, an interrupted join() can lose the thread)
+	thread.start()
+	while thread.is_alive():
+		try:
+			time.sleep( .1 )
+		except KeyboardInterrupt:
+			stopevent.set()
+	thread.join()
+
+def guarded( function, stopevent ):
+	# function() in a thread (see wait), returns ( its result, None ) or ( None, the error it raised ):
+	# a batch that cannot start (unwritable trace ...) ends with one line, not a traceback
+	outcome = {}
+	def target():
+		try:
+			outcome[ 'value' ] = function()
+		except Exception as e:
+			outcome[ 'failed' ] = ( str( e ) or type( e ).__name__ )
+
+	wait( threading.Thread( target = target, daemon = True ), stopevent )
+	if 'failed' in outcome:
+		sys.stderr.write( 'batchSigning: %s\n' % outcome[ 'failed' ] )
+
+	return ( outcome.get( 'value' ), outcome.get( 'failed' ) )
+
+def run( args ):
+	if not check( args ):
+		return ( 2 )
+
+	result = {}
+	stopevent = threading.Event()
+
+	def finished( canceled, success, errors, ignored, skipped ):
+		result.update( { 'event': 'finished', 'canceled': bool( canceled ), 'success': len( success ), 'duplicates': success.results.count( Results.DUPLICATES ), 'errors': len( errors ), 'ignored': len( ignored ), 'skipped': len( skipped ) } )
+
+	files = scan( args.gallery, args.depth, args.include, args.exclude, skip = [ args.target ] )
+	kwargs = settings( args )
+	kwargs.update( {
+		'gallery':		args.gallery,
+		'incremental':	args.incremental,
+		'job':			getattr( args, 'job', None ),
+		'options':		{ 'depth': args.depth, 'include': args.include, 'exclude': args.exclude },
+		'stopevent':	stopevent,
+		'sigprogress':	progress( args ),
+		'sigfinished':	finished
+	} )
+
+	if guarded( lambda: process( files, args.watermark, args.target, **kwargs ), stopevent )[ 1 ]:
+		return ( 2 )
+	summary( args, result )
+
+	if result.get( 'canceled' ):
+		return ( 130 )
+	return ( 1 if result.get( 'errors' ) else 0 )
+
+def watch( args ):
+	from watch import watch
+
+	if not check( args ):
+		return ( 2 )
+
+	stopevent = threading.Event()
+
+	kwargs = settings( args )
+	kwargs.update( {
+		'settle':		args.settle,
+		'interval':		args.interval,
+		'polling':		args.polling,
+		'depth':		args.depth,
+		'include':		args.include,
+		'exclude':		args.exclude,
+		'stopevent':	stopevent,
+		'sigprogress':	progress( args )
+	} )
+
+	batch, failed = guarded( lambda: watch( args.watermark, args.gallery, args.target, **kwargs ), stopevent )
+	if failed:
+		return ( 2 )
+	if batch:
+		success, errors, ignored, skipped = batch.results
+		summary( args, { 'event': 'finished', 'canceled': True, 'success': len( success ), 'errors': len( errors ), 'ignored': len( ignored ), 'skipped': len( skipped ) } )
+
+	return ( 0 )
+
+def resume( args ):
+	from batch import Job
+
+	job = Job.load( args.target )
+	if not job or job.get( 'state' ) == 'finished':
+		sys.stderr.write( 'batchSigning: no interrupted batch in %s\n' % args.target )
+		return ( 2 )
+
+	# the same run, photos this job already finished are skipped
+	values = {
+		'quality':		100,
+		'opacity':		100,
+		'gravity':		'Center',
+		'position':		[ 0, 0 ],
+		'size':			[ 0, 0 ],
+		'workers':		None,
+		'engine':		'composite',
+		'chunk':		64,
+		'megapixels':	512,
+		'incremental':	True,
+		'checksum':		False,
+		'maxsize':		None,
+		'renditions':	None,
+		'timeout':		None,
+		'retries':		2,
+		'dedupe':		None,
+		'prefetch':		None,
+		'prefetchsize':	None,
+		'prefetchcache':	None,
+		'budget':		None,
+		'disk':			None,
+		'scratch':		None
+	}
+	values.update( ( key, value ) for key, value in job.get( 'settings', {} ).items() if key in values )
+	values.update( { 'depth': None, 'include': None, 'exclude': None } )
+	values.update( job.get( 'options', {} ) )
+	values.update( {
+		'watermark':	job[ 'watermark' ],
+		'gallery':		job[ 'gallery' ],
+		'target':		job[ 'target' ],
+		'job':			job[ 'id' ],
+		'json':			args.json,
+		'trace':		args.trace
+	} )
+
+	return ( run( argparse.Namespace( **values ) ) )
+
+def enqueue( args ):
+	from cluster import enqueue
+
+	if not check( args ):
+		return ( 2 )
+
+	kwargs = settings( args )
+	kwargs.pop( 'trace' )
+
+	files = scan( args.gallery, args.depth, args.include, args.exclude, skip = [ args.target ] )
+	count, counts = enqueue( files, args.watermark, args.target, args.gallery, args.incremental, args.lease, { 'depth': args.depth, 'include': args.include, 'exclude': args.exclude }, **kwargs )
+
+	counts.update( { 'event': 'queued', 'files': count } )
+	if args.json:
+		sys.stdout.write( json.dumps( counts ) + '\n' )
+	else:
+		sys.stdout.write( '%(files)d queued: %(pending)d to do, %(claimed)d in progress, %(ok)d done, %(skipped)d up to date, %(error)d errors\n' % counts )
+
+	return ( 0 )
+
+def worker( args ):
+	from cluster import Queue, work
+
+	if not os.path.isfile( os.path.join( args.target, Queue.name ) ):
+		sys.stderr.write( 'batchSigning: no queue in %s\n' % args.target )
+		return ( 2 )
+
+	stopevent = threading.Event()
+
+	kwargs = {
+		'node':			args.name,
+		'stopevent':	stopevent,
+		'sigprogress':	progress( args ),
+		'trace':		args.trace,
+		'workers':		args.workers,
+		'budget':		args.budget,
+		'disk':			args.disk,
+		'scratch':		args.scratch
+	}
+
+	batch, failed = guarded( lambda: work( args.target, **kwargs ), stopevent )
+	if failed:
+		return ( 2 )
+	if not batch:
+		sys.stderr.write( 'batchSigning: no queue in %s\n' % args.target )
+		return ( 2 )
+
+	# what this worker did, the queue holds the whole batch
+	success, errors, ignored, skipped = batch.results
+	summary( args, { 'event': 'finished', 'canceled': stopevent.is_set(), 'success': len( success ), 'errors': len( errors ), 'ignored': len( ignored ), 'skipped': len( skipped ) } )
+
+	if stopevent.is_set():
+		return ( 130 )
+	return ( 1 if errors else 0 )
+
+def bench( args ):
+	from bench import bench
+
+	baseline = None
+	if args.baseline:
+		try:
+			with open( args.baseline, 'r', encoding = 'utf-8' ) as f:
+				baseline = json.loads( f.read() )
+		except ( OSError, ValueError ) as e:
+			sys.stderr.write( 'batchSigning: invalid baseline: %s\n' % e )
+			return ( 2 )
+
+	def sigresult( result ):
+		# one line per configuration while it runs, the full report goes to stdout
+		if 'error' in result:
+			sys.stderr.write( '%(engine)s x%(workers)d: %(error)s\n' % result )
+		else:
+			sys.stderr.write( '%(engine)s x%(workers)d: %(files_per_second).2f files/s, %(megapixels_per_second).2f MP/s, p95 %(p95)s ms\n' % result )
+		sys.stderr.flush()
+
+	report = bench( args.watermark, args.gallery, args.files, args.formats, args.resolutions, args.engines, args.workers, args.chunk, args.repeat, args.seed, baseline, args.threshold, sigresult )
+
+	data = json.dumps( report, indent = 2 )
+	if args.output:
+		with open( args.output, 'w', encoding = 'utf-8' ) as f:
+			f.write( data + '\n' )
+	sys.stdout.write( data + '\n' )
+
+	for item in report.get( 'regressions', [] ):
+		sys.stderr.write( 'regression: %(engine)s x%(workers)d %(metric)s %(baseline)s -> %(value)s\n' % item )
+
+	# a configuration that failed is a regression too, whatever the baseline
+	return ( 1 if report.get( 'regressions' ) or any( 'error' in item for item in report[ 'results' ] ) else 0 )
+
+def launch( argv = None ):
+	commands = {
+		'run':		run,
+		'watch':	watch,
+		'resume':	resume,
+		'enqueue':	enqueue,
+		'worker':	worker,
+		'bench':	bench
+	}
+
+	args = parser().parse_args( argv )
+	sys.exit( commands[ args.command ]( args ) )
+
+if __name__ == '__main__':
+	launch()
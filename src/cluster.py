@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import contextlib
+
+# local
+from batch import Batch, outcome
+from engines import BatchEngine
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS job ( key TEXT PRIMARY KEY, value TEXT );
+CREATE TABLE IF NOT EXISTS items (
+	file TEXT PRIMARY KEY,
+	size INTEGER,
+	mtime INTEGER,
+	state TEXT NOT NULL DEFAULT 'pending',
+	worker TEXT,
+	lease REAL,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	output TEXT
+);
+CREATE INDEX IF NOT EXISTS items_state ON items ( state, lease );
+'''
+
+class Queue( object ):
+	# the work items of a distributed batch, in its target (shared by every node, no broker)
+	# state: pending -> claimed (by a worker, until its lease expires) -> ok, skipped or error
+	name = '.batchSigning.queue.db'
+
+	def __init__( self, target, lease = 60., attempts = 3 ):
+		self.file = os.path.join( target, self.name )
+		self.lease = lease
+		self.attempts = attempts
+
+		# autocommit, each change is its own short transaction
+		self.db = sqlite3.connect( self.file, timeout = 60, isolation_level = None )
+		self.db.executescript( SCHEMA )
+
+	@contextlib.contextmanager
+	def transaction( self ):
+		# the write lock right away: two workers never claim the same items
+		self.db.execute( 'BEGIN IMMEDIATE' )
+		try:
+			yield ( self.db )
+		except BaseException:
+			self.db.execute( 'ROLLBACK' )
+			raise
+		self.db.execute( 'COMMIT' )
+
+	def job( self ):
+		row = self.db.execute( "SELECT value FROM job WHERE key = 'job'" ).fetchone()
+		return ( json.loads( row[ 0 ] ) if row else None )
+
+	# job: what the workers run with, output: the part of it the outputs depend on (see batch.outcome)
+	def setup( self, job, output, incremental = True ):
+		output = json.dumps( output, sort_keys = True )
+		with self.transaction() as db:
+			# other outputs (or --all): every photo is done again, not for a new lease or other machine defaults
+			row = db.execute( "SELECT value FROM job WHERE key = 'output'" ).fetchone()
+			if not incremental or not row or row[ 0 ] != output:
+				db.execute( "UPDATE items SET state = 'pending', worker = NULL, lease = NULL, attempts = 0, output = NULL" )
+
+			db.execute( "INSERT OR REPLACE INTO job ( key, value ) VALUES ( 'job', ? )", ( json.dumps( job, sort_keys = True ), ) )
+			db.execute( "INSERT OR REPLACE INTO job ( key, value ) VALUES ( 'output', ? )", ( output, ) )
+			db.execute( "INSERT OR REPLACE INTO job ( key, value ) VALUES ( 'filled', '0' )" )
+
+	# files may be a generator (see core.scan), returns how many were seen
+	def enqueue( self, files, block = 1000 ):
+		def stat( file ):
+			try:
+				info = os.stat( file )
+				return ( ( os.path.abspath( file ), info.st_size, info.st_mtime_ns ) )
+			except OSError:
+				return ( None )
+
+		# a photo already there only goes back to pending when it changed or failed
+		query = '''INSERT INTO items ( file, size, mtime ) VALUES ( ?, ?, ? )
+			ON CONFLICT ( file ) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, state = 'pending', worker = NULL, lease = NULL, attempts = 0, output = NULL
+			WHERE items.size IS NOT excluded.size OR items.mtime IS NOT excluded.mtime OR items.state = 'error' '''
+
+		count = 0
+		rows = []
+		for file in files:
+			row = stat( file )
+			if row:
+				rows.append( row )
+			if len( rows ) >= block:
+				with self.transaction() as db:
+					db.executemany( query, rows )
+				count += len( rows )
+				rows = []
+		if rows:
+			with self.transaction() as db:
+				db.executemany( query, rows )
+			count += len( rows )
+
+		return ( count )
+
+	def fill( self ):
+		# nothing more to come: idle workers may leave once the queue is drained
+		self.db.execute( "INSERT OR REPLACE INTO job ( key, value ) VALUES ( 'filled', '1' )" )
+
+	def claim( self, worker, count ):
+		now = time.time()
+		with self.transaction() as db:
+			# expired that many times, the photo is likely what kills its workers
+			db.execute( "UPDATE items SET state = 'error', worker = NULL, lease = NULL, output = ? WHERE state = 'claimed' AND lease < ? AND attempts >= ?", ( 'lease expired %d times' % self.attempts, now, self.attempts ) )
+
+			# the leases of dead workers expire, their photos go back to the queue
+			files = [ row[ 0 ] for row in db.execute( "SELECT file FROM items WHERE state = 'pending' OR ( state = 'claimed' AND lease < ? ) ORDER BY rowid LIMIT ?", ( now, count ) ) ]
+			db.executemany( "UPDATE items SET state = 'claimed', worker = ?, lease = ?, attempts = attempts + 1 WHERE file = ?", [ ( worker, now + self.lease, file ) for file in files ] )
+
+		return ( files )
+
+	def renew( self, worker, files ):
+		lease = ( time.time() + self.lease )
+		with self.transaction() as db:
+			db.executemany( "UPDATE items SET lease = ? WHERE file = ? AND worker = ? AND state = 'claimed'", [ ( lease, file, worker ) for file in files ] )
+
+	# results: [ ( file, state, output ) ], only while the worker still holds the lease
+	def finish( self, worker, results ):
+		if not results:
+			return
+
+		with self.transaction() as db:
+			db.executemany( "UPDATE items SET state = ?, output = ?, lease = NULL WHERE file = ? AND worker = ? AND state = 'claimed'", [ ( state, output, file, worker ) for file, state, output in results ] )
+
+	def release( self, worker, files ):
+		# not done (canceled), back to the queue without counting as an attempt
+		if not files:
+			return
+
+		with self.transaction() as db:
+			db.executemany( "UPDATE items SET state = 'pending', worker = NULL, lease = NULL, attempts = MAX( 0, attempts - 1 ) WHERE file = ? AND worker = ? AND state = 'claimed'", [ ( file, worker ) for file in files ] )
+
+	def counts( self ):
+		counts = { 'pending': 0, 'claimed': 0, 'ok': 0, 'skipped': 0, 'error': 0 }
+		counts.update( self.db.execute( 'SELECT state, COUNT( * ) FROM items GROUP BY state' ).fetchall() )
+
+		return ( counts )
+
+	def drained( self ):
+		row = self.db.execute( "SELECT value FROM job WHERE key = 'filled'" ).fetchone()
+		if not row or row[ 0 ] != '1':
+			return ( False )
+
+		counts = self.counts()
+		return ( not ( counts[ 'pending' ] or counts[ 'claimed' ] ) )
+
+	def errors( self ):
+		return ( self.db.execute( "SELECT file, output FROM items WHERE state = 'error' ORDER BY rowid" ).fetchall() )
+
+	def close( self ):
+		self.db.close()
+
+def enqueue( files, watermark, target, gallery = None, incremental = True, lease = 60., options = None, **settings ):
+	# the coordinator: the same settings for every worker, machine specific ones (workers, memory ...) are their defaults
+	os.makedirs( target, exist_ok = True )
+
+	queue = Queue( target, lease )
+	try:
+		output = dict( outcome( watermark, **settings ), gallery = ( gallery and os.path.abspath( gallery ) ), target = os.path.abspath( target ) )
+		queue.setup( {
+			'watermark':	os.path.abspath( watermark ),
+			'gallery':		( gallery and os.path.abspath( gallery ) ),
+			'target':		os.path.abspath( target ),
+			'lease':		lease,
+			'options':		( options or {} ),
+			'settings':		settings
+		}, output, incremental )
+		count = queue.enqueue( files )
+		queue.fill()
+
+		return ( count, queue.counts() )
+	finally:
+		queue.close()
+
+def work( target, node = None, stopevent = None, sigprogress = None, trace = None, interval = 1., **kwargs ):
+	# a worker, on any node: claims photos until the queue is drained (or stopevent is set)
+	node = ( node or '%s:%d' % ( socket.gethostname(), os.getpid() ) )
+	stopevent = ( stopevent or threading.Event() )
+
+	queue = Queue( target )
+	job = queue.job()
+	if not job:
+		queue.close()
+		return ( None )
+
+	queue.lease = job[ 'lease' ]
+	settings = dict( job[ 'settings' ] )
+	settings.update( ( key, value ) for key, value in kwargs.items() if value is not None )
+
+	lock = threading.Lock()
+	finished = []
+	def progress( index, total, file, cmd, error, output ):
+		if error is not None:
+			with lock:
+				finished.append( ( file, ( 'error' if error else ( 'skipped' if cmd is None else 'ok' ) ), ( output or '' ) ) )
+
+		if sigprogress:
+			sigprogress( index, total, file, cmd, error, output )
+
+	def collect():
+		with lock:
+			results = finished[ : ]
+			del finished[ : ]
+
+		queue.finish( node, results )
+		claimed.difference_update( file for file, state, output in results )
+
+	batch = Batch( job[ 'watermark' ], job[ 'target' ], gallery = job[ 'gallery' ], stopevent = stopevent, sigprogress = progress, trace = trace, node = node, **settings )
+	batch.start()
+
+	# enough claimed to keep every worker busy, not so much that a slow node holds photos others could take
+	depth = ( batch.workers * ( batch.chunk if batch.engine.name == BatchEngine.name else 2 ) )
+	claimed = set()
+	renewed = time.monotonic()
+	try:
+		while not stopevent.is_set():
+			collect()
+
+			files = []
+			if len( claimed ) <= ( depth // 2 ):
+				files = queue.claim( node, ( depth - len( claimed ) ) )
+				claimed.update( files )
+				if files:
+					batch.feed( files )
+
+			now = time.monotonic()
+			if claimed and ( now - renewed ) >= ( queue.lease / 3 ):
+				queue.renew( node, claimed )
+				renewed = now
+
+			if not claimed and not files and queue.drained():
+				break
+
+			stopevent.wait( .2 if claimed else interval )
+	finally:
+		batch.close()
+		collect()
+		queue.release( node, claimed )
+		queue.close()
+
+	return ( batch )
@@ -0,0 +1,651 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+DIVIDE = [ 'png', 'tiff' ]
+LOSSY = [ 'jpg', 'jpeg', 'webp' ]
+EXTENSIONS = [ 'png', 'jpeg', 'tiff', 'webp' ]
+GRAVITIES = [ 'NorthWest', 'North', 'NorthEast', 'West', 'Center', 'East', 'SouthWest', 'South', 'SouthEast' ]
+
+# built-in
+import os
+import sys
+import time
+import array
+import queue
+import struct
+import fnmatch
+import atexit
+import shutil
+import hashlib
+import tempfile
+import collections
+import threading
+import traceback
+import subprocess
+
+# platform
+os_name = sys.platform
+os_name = ( 'windows' if os_name.startswith( 'win' ) else os_name )
+os_name = ( 'linux' if os_name.startswith( 'linux' ) else os_name )
+
+# appdata
+appdata = os.getenv( 'APPDATA', None )
+if not appdata:
+	appdata = os.path.join( os.getenv( 'HOME' ), '.config' )
+appdata = os.path.join( appdata, 'batchSigning' )
+
+# fix subprocess poped window
+startupinfo = None
+if sys.platform == 'win32':
+	startupinfo = subprocess.STARTUPINFO()
+	startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+
+def exec_path( relative_path = '' ):
+	if getattr( sys, 'frozen', False ) and getattr( sys, '_MEIPASS', False ):
+		tmp = os.path.dirname( sys.executable )
+	else:
+		tmp = os.path.dirname( os.path.realpath( __file__ ) )
+
+	return ( os.path.join( tmp, relative_path ) )
+
+def resource_path( relative_path = '' ):
+	if getattr( sys, '_MEIPASS', False ):
+		tmp = sys._MEIPASS
+	else:
+		tmp = os.path.dirname( os.path.realpath( __file__ ) )
+
+	return ( os.path.join( tmp, relative_path ) )
+
+def resource( *args, **kwargs ):
+	global os_name
+
+	path = os.path.join( *args )
+	if 'root' not in kwargs or not kwargs[ 'root' ]:
+		path = os.path.join( 'resources', path )
+	if 'bin' in kwargs and kwargs[ 'bin' ] and os_name == 'windows':
+		path += '.exe'
+
+	return ( resource_path( path ) )
+
+def extensions():
+	global EXTENSIONS
+
+	exts = []
+	for ext in EXTENSIONS:
+		exts.append( ext )
+		if ext == 'jpeg':
+			exts.append( 'jpg' )
+
+	return ( exts )
+
+def match( relative, patterns ):
+	name = os.path.basename( relative )
+	return ( any( fnmatch.fnmatch( relative, pattern ) or fnmatch.fnmatch( name, pattern ) for pattern in patterns ) )
+
+def selected( gallery, file, depth = None, include = None, exclude = None, skip = None ):
+	# same rules as scan(), for a single file
+	relative = os.path.relpath( file, gallery ).replace( os.sep, '/' )
+	if relative.startswith( '../' ) or ( depth is not None and relative.count( '/' ) > depth ):
+		return ( False )
+	if file.split( '.' )[ -1 ].lower() not in extensions():
+		return ( False )
+
+	parts = relative.split( '/' )
+	for index in range( len( parts ) ):
+		if exclude and match( '/'.join( parts[ :( index + 1 ) ] ), exclude ):
+			return ( False )
+
+	folder = os.path.realpath( os.path.dirname( file ) )
+	for item in ( skip or [] ):
+		item = os.path.realpath( item )
+		if folder == item or folder.startswith( item + os.sep ):
+			return ( False )
+
+	return ( not include or match( relative, include ) )
+
+def scan( gallery, depth = None, include = None, exclude = None, skip = None, entries = False ):
+	# yields the photos of `gallery` while walking it, `depth` 0 stays at the top level, None has no limit
+	# entries: their os.DirEntry rather than paths, the stat of the listing comes with it (free on Windows)
+	exts = extensions()
+	skip = [ os.path.realpath( item ) for item in ( skip or [] ) ]
+
+	folders = [ ( gallery, 0 ) ]
+	while folders:
+		folder, level = folders.pop()
+
+		try:
+			listing = os.scandir( folder )
+		except OSError:
+			continue
+
+		subfolders = []
+		with listing:
+			for entry in listing:
+				relative = os.path.relpath( entry.path, gallery ).replace( os.sep, '/' )
+				if exclude and match( relative, exclude ):
+					continue
+
+				try:
+					if entry.is_dir( follow_symlinks = False ):
+						if ( depth is None or level < depth ) and os.path.realpath( entry.path ) not in skip:
+							subfolders.append( ( entry.path, ( level + 1 ) ) )
+						continue
+					if not entry.is_file():
+						continue
+				except OSError:
+					continue
+
+				if entry.name.split( '.' )[ -1 ].lower() in exts and ( not include or match( relative, include ) ):
+					yield ( entry if entries else entry.path )
+
+		folders.extend( reversed( subfolders ) )
+
+def getfilesize( file ):
+	filesize = str( os.path.getsize( file ) )
+
+	lencut = 0
+	lensize = len( filesize )
+	if ( lensize > 12 ):
+		lencut = 12
+	elif ( lensize > 9 ):
+		lencut = 9
+	elif ( lensize > 6 ):
+		lencut = 6
+	elif ( lensize > 3 ):
+		lencut = 3
+
+	lensuffix = { 0: '', 3: 'K', 6: 'M', 9: 'G', 12: 'T' }
+	if lencut:
+		filesize = filesize[ 0:-( lencut ) ] + '.' + filesize[ -( lencut ):-( lencut - 1 ) ]
+	filesize += ' ' + lensuffix[ lencut ] + 'o'
+
+	return ( filesize )
+
+def dimensions( file ):
+	# width and height read from the file header, without decoding the image
+	try:
+		with open( file, 'rb' ) as f:
+			head = f.read( 32 )
+
+			if head[ :8 ] == b'\x89PNG\r\n\x1a\n':
+				return ( struct.unpack( '>II', head[ 16:24 ] ) )
+
+			if head[ :4 ] == b'RIFF' and head[ 8:12 ] == b'WEBP':
+				chunk = head[ 12:16 ]
+				if chunk == b'VP8 ':
+					width, height = struct.unpack( '<HH', head[ 26:30 ] )
+					return ( ( width & 0x3fff ), ( height & 0x3fff ) )
+				elif chunk == b'VP8L':
+					bits = struct.unpack( '<I', head[ 21:25 ] )[ 0 ]
+					return ( ( ( bits & 0x3fff ) + 1 ), ( ( ( bits >> 14 ) & 0x3fff ) + 1 ) )
+				elif chunk == b'VP8X':
+					return ( ( int.from_bytes( head[ 24:27 ], 'little' ) + 1 ), ( int.from_bytes( head[ 27:30 ], 'little' ) + 1 ) )
+				return ( None )
+
+			if head[ :4 ] in [ b'II*\x00', b'MM\x00*' ]:
+				order = ( '<' if head[ :2 ] == b'II' else '>' )
+				f.seek( struct.unpack( order + 'I', head[ 4:8 ] )[ 0 ] )
+				count = struct.unpack( order + 'H', f.read( 2 ) )[ 0 ]
+
+				size = {}
+				for index in range( count ):
+					tag, kind, number, value = struct.unpack( order + 'HHI4s', f.read( 12 ) )
+					if tag in [ 256, 257 ]:
+						size[ tag ] = struct.unpack( order + ( 'H' if kind == 3 else 'I' ), value[ :( 2 if kind == 3 else 4 ) ] )[ 0 ]
+				if len( size ) == 2:
+					return ( size[ 256 ], size[ 257 ] )
+				return ( None )
+
+			if head[ :2 ] == b'\xff\xd8':
+				f.seek( 2 )
+				while True:
+					byte = f.read( 1 )
+					if not byte:
+						return ( None )
+					if byte != b'\xff':
+						continue
+
+					marker = f.read( 1 )
+					while marker == b'\xff':
+						marker = f.read( 1 )
+					marker = ord( marker or b'\x00' )
+					if marker in [ 0x01, 0xd8 ] or 0xd0 <= marker <= 0xd7:
+						continue
+
+					length = struct.unpack( '>H', f.read( 2 ) )[ 0 ]
+					if 0xc0 <= marker <= 0xcf and marker not in [ 0xc4, 0xc8, 0xcc ]:
+						height, width = struct.unpack( '>xHH', f.read( 5 ) )
+						return ( width, height )
+					f.seek( length - 2, os.SEEK_CUR )
+	except ( OSError, struct.error ):
+		pass
+
+	return ( None )
+
+class Profile( object ):
+	def __init__( self, started = None ):
+		self.started = ( time.perf_counter() if started is None else started )
+		self.last = self.started
+		self.phases = []
+
+	def mark( self, name ):
+		now = time.perf_counter()
+		self.phases.append( ( name, ( now - self.last ) ) )
+		self.last = now
+
+	def report( self, stream = None ):
+		stream = ( stream or sys.stderr )
+
+		for name, duration in ( self.phases + [ ( 'total', ( self.last - self.started ) ) ] ):
+			stream.write( '%-12s %8.1f ms\n' % ( name, ( duration * 1000 ) ) )
+		stream.flush()
+
+def cost( file ):
+	# bytes of a decoded photo in ImageMagick's Q16 pixel cache (4 channels of 2 bytes), plus the process itself
+	size = dimensions( file )
+	if not size:
+		return ( 64 << 20 )
+
+	return ( size[ 0 ] * size[ 1 ] * 8 + ( 32 << 20 ) )
+
+def memory():
+	# physical memory in bytes, None when unknown
+	try:
+		return ( os.sysconf( 'SC_PAGE_SIZE' ) * os.sysconf( 'SC_PHYS_PAGES' ) )
+	except ( AttributeError, ValueError, OSError ):
+		return ( None )
+
+class Budget( object ):
+	# admits work while the sum of the costs stays under capacity, first come first served
+	# (a huge photo is not starved by small ones), a photo alone is always admitted
+	def __init__( self, capacity ):
+		self.capacity = capacity
+		self.used = 0
+		self.waiting = collections.deque()
+		self.condition = threading.Condition()
+
+	def acquire( self, cost, stopevent = None ):
+		ticket = object()
+		with self.condition:
+			self.waiting.append( ticket )
+			try:
+				while self.waiting[ 0 ] is not ticket or ( self.used and ( self.used + cost ) > self.capacity ):
+					if stopevent and stopevent.is_set():
+						return ( False )
+					self.condition.wait( .1 )
+
+				self.used += cost
+				return ( True )
+			finally:
+				self.waiting.remove( ticket )
+				self.condition.notify_all()
+
+	def release( self, cost ):
+		with self.condition:
+			self.used -= cost
+			self.condition.notify_all()
+
+class Pool( object ):
+	def __init__( self, workers = None ):
+		self.workers = max( 1, ( workers or os.cpu_count() or 1 ) )
+		self.tasks = queue.Queue( self.workers * 2 )
+		self.threads = []
+
+		for index in range( self.workers ):
+			thread = threading.Thread( target = self.loop, daemon = True )
+			thread.start()
+			self.threads.append( thread )
+
+	def loop( self ):
+		while True:
+			task = self.tasks.get()
+			try:
+				if task is None:
+					return
+
+				callback, args = task
+				callback( *args )
+			except Exception:
+				traceback.print_exc()
+			finally:
+				self.tasks.task_done()
+
+	def submit( self, callback, *args ):
+		self.tasks.put( ( callback, args ) )
+
+	# drops the tasks not started yet and returns them
+	def clear( self ):
+		tasks = []
+		stops = 0
+		while True:
+			try:
+				task = self.tasks.get_nowait()
+			except queue.Empty:
+				break
+
+			self.tasks.task_done()
+			if task is None:
+				stops += 1
+			else:
+				tasks.append( task )
+
+		# close() may already be waiting on the workers
+		for index in range( stops ):
+			self.tasks.put( None )
+
+		return ( tasks )
+
+	def close( self ):
+		for thread in self.threads:
+			self.tasks.put( None )
+		for thread in self.threads:
+			thread.join()
+
+class Prefetcher( object ):
+	# reads the photos ahead of the workers, while they render: into the page cache (posix_fadvise then a read),
+	# or copied into `folder` (a local scratch cache), at most `files` photos and `size` bytes not released yet
+	def __init__( self, files = 8, size = None, folder = None ):
+		self.files = max( 1, files )
+		self.size = size
+		self.folder = None
+		if folder:
+			os.makedirs( folder, exist_ok = True )
+			self.folder = tempfile.mkdtemp( prefix = 'batchSigning-prefetch-', dir = folder )
+
+		self.condition = threading.Condition()
+		self.queue = collections.deque()
+		self.pending = set()
+		self.ready = {}
+		self.held = 0
+		self.current = None
+		self.dropped = False
+		self.closed = False
+
+		self.thread = threading.Thread( target = self.loop, daemon = True )
+		self.thread.start()
+
+	def add( self, files ):
+		with self.condition:
+			for file in files:
+				self.queue.append( file )
+				self.pending.add( file )
+			self.condition.notify_all()
+
+	def loop( self ):
+		while True:
+			with self.condition:
+				# a photo alone is always read, whatever its size
+				while not self.closed and ( not self.queue or len( self.ready ) >= self.files or ( self.size and self.held >= self.size ) ):
+					self.condition.wait()
+				if self.closed:
+					return
+
+				file = self.queue.popleft()
+				if file not in self.pending:
+					continue
+				self.pending.discard( file )
+				self.current, self.dropped = ( file, False )
+
+			try:
+				path, size = self.fetch( file )
+			except OSError:
+				path, size = ( None, 0 )
+
+			with self.condition:
+				self.current = None
+				if path and not self.dropped:
+					self.ready[ file ] = ( path, size )
+					self.held += size
+					path = None
+			if path:
+				self.discard( file, path )
+
+	def fetch( self, file ):
+		if self.folder:
+			# unique per source, its name kept for the diagnostics
+			path = os.path.join( self.folder, '%s-%s' % ( hashlib.sha1( os.path.abspath( file ).encode( 'utf-8', 'surrogateescape' ) ).hexdigest()[ :16 ], os.path.basename( file ) ) )
+			shutil.copyfile( file, path )
+			return ( path, os.path.getsize( path ) )
+
+		size = 0
+		buffer = bytearray( 1 << 20 )
+		fd = os.open( file, os.O_RDONLY )
+		try:
+			if hasattr( os, 'posix_fadvise' ):
+				os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_WILLNEED )
+
+			# the read is what a network filesystem honors
+			with open( fd, 'rb', buffering = 0, closefd = False ) as f:
+				while True:
+					count = f.readinto( buffer )
+					if not count:
+						break
+					size += count
+		finally:
+			os.close( fd )
+
+		return ( file, size )
+
+	def discard( self, file, path ):
+		try:
+			if self.folder:
+				os.remove( path )
+			elif hasattr( os, 'posix_fadvise' ):
+				fd = os.open( file, os.O_RDONLY )
+				try:
+					os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+				finally:
+					os.close( fd )
+		except OSError:
+			pass
+
+	# what a worker reads: the local copy once prefetched, never waits (a photo not read yet is not read any more)
+	def path( self, file ):
+		with self.condition:
+			entry = self.ready.get( file )
+			if not entry:
+				self.pending.discard( file )
+				return ( file )
+
+		return ( entry[ 0 ] )
+
+	def release( self, files ):
+		# done with: evicted from the cache, the next ones may be read
+		released = []
+		with self.condition:
+			for file in files:
+				self.pending.discard( file )
+				if file == self.current:
+					self.dropped = True
+
+				entry = self.ready.pop( file, None )
+				if entry:
+					self.held -= entry[ 1 ]
+					released.append( ( file, entry[ 0 ] ) )
+			self.condition.notify_all()
+
+		for file, path in released:
+			self.discard( file, path )
+
+	def close( self ):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		self.thread.join()
+
+		self.release( list( self.ready.keys() ) )
+		if self.folder:
+			shutil.rmtree( self.folder, True )
+
+class Progress( object ):
+	# sigprogress of a batch, coalesced into at most `rate` calls per second of:
+	# callback( index, done, total, file, errors ), errors being the ( file, output ) since the last call
+	def __init__( self, callback, rate = 10, detail = None ):
+		self.callback = callback
+		self.detail = detail
+		self.delay = ( 1. / max( 1, rate ) )
+		self.lock = threading.Lock()
+		self.timer = None
+		self.sent = 0
+
+		self.index = 0
+		self.done = 0
+		self.total = 0
+		self.file = ''
+		self.errors = []
+		self.changed = False
+
+	def __call__( self, index, total, file, cmd, error, output ):
+		# the full event, from the worker thread
+		if self.detail:
+			self.detail( index, total, file, cmd, error, output )
+
+		with self.lock:
+			self.total = total
+			if error is None:
+				self.index = index
+				self.file = file
+			else:
+				self.done += 1
+				if error:
+					self.errors.append( ( file, output ) )
+			self.changed = True
+
+			remaining = ( self.sent + self.delay - time.monotonic() )
+			if remaining > 0:
+				# the last state still gets out once the window is over
+				if not self.timer:
+					self.timer = threading.Timer( remaining, self.flush )
+					self.timer.daemon = True
+					self.timer.start()
+				return
+
+		self.flush()
+
+	def flush( self ):
+		# under the lock, so that two states never cross each other
+		with self.lock:
+			if self.timer:
+				self.timer.cancel()
+				self.timer = None
+			if not self.changed:
+				return
+
+			self.callback( self.index, self.done, self.total, self.file, self.errors )
+			self.errors = []
+			self.changed = False
+			self.sent = time.monotonic()
+
+class Results( object ):
+	# what became of each photo of a batch, compact (a status byte, then offsets and utf-8 bytes of its path and output)
+	# iterated as the ( success, errors, ignored, skipped ) sequences of sigfinished, duplicates are also among success
+	SUCCESS, ERRORS, IGNORED, SKIPPED, DUPLICATES = range( 5 )
+
+	def __init__( self ):
+		self.lock = threading.Lock()
+		self.paths = bytearray()
+		self.offsets = array.array( 'Q', [ 0 ] )
+		self.outputs = bytearray()
+		self.ends = array.array( 'Q', [ 0 ] )
+		self.states = array.array( 'B' )
+		self.rows = [ array.array( 'I' ) for index in range( 5 ) ]
+
+	# outputs: the diagnostics of each file (stderr ...), none by default
+	def add( self, status, files, outputs = None, duplicate = False ):
+		with self.lock:
+			for index, file in enumerate( files ):
+				if duplicate:
+					self.rows[ Results.DUPLICATES ].append( len( self.states ) )
+				self.rows[ status ].append( len( self.states ) )
+				self.states.append( status )
+				self.paths += file.encode( 'utf-8', 'surrogateescape' )
+				self.offsets.append( len( self.paths ) )
+				self.outputs += ( ( outputs[ index ] or '' ).strip().encode( 'utf-8', 'replace' ) if outputs else b'' )
+				self.ends.append( len( self.outputs ) )
+
+	def path( self, row ):
+		with self.lock:
+			return ( self.paths[ self.offsets[ row ]:self.offsets[ row + 1 ] ].decode( 'utf-8', 'surrogateescape' ) )
+
+	def output( self, row ):
+		with self.lock:
+			return ( self.outputs[ self.ends[ row ]:self.ends[ row + 1 ] ].decode( 'utf-8', 'replace' ) )
+
+	def status( self, row ):
+		return ( self.states[ row ] )
+
+	def count( self, status = None ):
+		return ( len( self.states if status is None else self.rows[ status ] ) )
+
+	def view( self, status = None ):
+		return ( Results.View( self, status ) )
+
+	def __len__( self ):
+		return ( len( self.states ) )
+
+	def __iter__( self ):
+		return ( iter( [ self.view( status ) for status in range( 4 ) ] ) )
+
+	class View( object ):
+		# the photos of one status (every photo for None), paths decoded on access only
+		def __init__( self, results, status = None ):
+			self.results = results
+			self.status = status
+
+		def row( self, index ):
+			return ( index if self.status is None else self.results.rows[ self.status ][ index ] )
+
+		def __len__( self ):
+			return ( self.results.count( self.status ) )
+
+		def __getitem__( self, index ):
+			if index < 0:
+				index += len( self )
+			if index < 0 or index >= len( self ):
+				raise IndexError( index )
+
+			return ( self.results.path( self.row( index ) ) )
+
+		def __iter__( self ):
+			for index in range( len( self ) ):
+				yield ( self[ index ] )
+
+class Cache( object ):
+	def __init__( self, capacity = 8 ):
+		self.capacity = capacity
+		self.items = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.folder = None
+
+	def path( self, key, ext ):
+		if not self.folder:
+			self.folder = tempfile.mkdtemp( prefix = 'batchSigning-' )
+			atexit.register( shutil.rmtree, self.folder, True )
+
+		name = hashlib.sha1( repr( key ).encode( 'utf-8' ) ).hexdigest()
+		return ( os.path.join( self.folder, '%s.%s' % ( name, ext ) ) )
+
+	def get( self, key, build, release = None ):
+		with self.lock:
+			if key in self.items:
+				self.items.move_to_end( key )
+				return ( self.items[ key ][ 0 ] )
+
+			value = build( key )
+			self.items[ key ] = ( value, release )
+
+			while len( self.items ) > self.capacity:
+				old, ( value_old, release_old ) = self.items.popitem( last = False )
+				if release_old:
+					release_old( value_old )
+
+			return ( value )
+
+	def clear( self ):
+		with self.lock:
+			while self.items:
+				old, ( value, release ) = self.items.popitem( last = False )
+				if release:
+					release( value )
+
+cache = Cache()
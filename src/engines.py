@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import errno
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+
+from core import DIVIDE, LOSSY, os_name, startupinfo, resource, cache, cost
+
+# since PIP, only loaded by the in-process engine: headless runs never import Qt
+QtCore = None
+QtGui = None
+
+# errors worth a retry: they come from the storage (network shares ...), not from the photo
+TRANSIENT = [ os.strerror( getattr( errno, name ) ).lower() for name in [ 'EIO', 'EAGAIN', 'EINTR', 'EBUSY', 'ESTALE', 'ENOLCK', 'ETIMEDOUT', 'ECONNRESET', 'ECONNABORTED', 'ENETDOWN', 'ENETUNREACH', 'EHOSTDOWN', 'EHOSTUNREACH' ] if hasattr( errno, name ) ]
+
+def transient( output ):
+	global TRANSIENT
+
+	output = ( output or '' ).lower()
+	return ( any( message in output for message in TRANSIENT ) )
+
+class Timeout( OSError ):
+	pass
+
+def qt():
+	global QtCore, QtGui
+
+	if QtGui is None:
+		from PyQt5 import QtCore, QtGui
+
+def prepare( watermark, size = ( 0, 0 ) ):
+	global cache, os_name, startupinfo
+
+	# decode (and resize) the watermark once, later calls map the pixel cache directly
+	def build( key ):
+		composite = resource( 'bin', os_name, 'composite', bin = True )
+		path = cache.path( key, 'mpc' )
+
+		image = [ watermark ]
+		if size[ 0 ] and size[ 1 ]:
+			image = [ '(', watermark, '-resize', ( '%dx%d!' % ( size[ 0 ], size[ 1 ] ) ), ')' ]
+
+		try:
+			subprocess.check_output( [ composite, '-compose', 'Src' ] + image + image + [ path ], stdin = subprocess.PIPE, stderr = subprocess.STDOUT, env = os.environ, startupinfo = startupinfo )
+		except ( subprocess.CalledProcessError, OSError ):
+			release( path )
+			return ( None )
+
+		return ( path )
+
+	def release( path ):
+		for file in [ path, ( path[ :-4 ] + '.cache' ) ]:
+			try:
+				os.remove( file )
+			except OSError:
+				pass
+
+	try:
+		key = ( os.path.realpath( watermark ), os.path.getmtime( watermark ), tuple( size ) )
+	except OSError:
+		return ( None )
+
+	return ( cache.get( key, build, release ) )
+
+def gravitate( width, height, wwidth, wheight, gravity = 'Center', position = ( 0, 0 ) ):
+	# same placement rules as ImageMagick's -gravity / -geometry
+	gravity = gravity.lower()
+	x, y = position
+
+	if gravity.endswith( 'east' ):
+		x = ( width - wwidth - x )
+	elif not gravity.endswith( 'west' ):
+		x += ( width // 2 - wwidth // 2 )
+
+	if gravity.startswith( 'south' ):
+		y = ( height - wheight - y )
+	elif not gravity.startswith( 'north' ):
+		y += ( height // 2 - wheight // 2 )
+
+	return ( x, y )
+
+def plane( image, table ):
+	# an 8 bits image (alpha, gray) mapped through a 256 entries table, by bytes.translate: no Python loop per pixel
+	data = image.constBits().asstring( image.sizeInBytes() ).translate( table )
+	return ( QtGui.QImage( data, image.width(), image.height(), image.bytesPerLine(), QtGui.QImage.Format_Grayscale8 ).copy() )
+
+class Engine( object ):
+	name = None
+	limited = False		# follows the -limit arguments below
+
+	def __init__( self, watermark, quality = 100, opacity = 100, gravity = 'Center', position = ( 0, 0 ), size = ( 0, 0 ) ):
+		self.watermark = watermark
+		self.opacity = opacity
+		self.gravity = gravity
+		self.position = position
+		self.size = size
+		self._quality = quality
+
+		self.lock = threading.Lock()
+		self.processes = set()
+		self.canceled = False
+
+		# ImageMagick -limit arguments, set by the caller: disk for every photo, spill for the ones costing more than budget,
+		# the others get a pixel cache of the memory they were admitted with (see core.cost)
+		self.disk = []
+		self.spill = []
+		self.budget = 0
+		self.environment = os.environ
+
+		# bytes, lossy outputs get the highest quality that fits (0: the quality setting as is)
+		self.maxsize = 0
+
+		# seconds a photo may take before its process is killed (0: no limit, the qt engine runs in process and has none)
+		self.timeout = 0
+
+	def quality( self, file, quality = None ):
+		global DIVIDE
+
+		q = ( quality or self._quality )
+		if file.split( '.' )[ -1 ].lower() in DIVIDE:
+			q = round( q / 10 )
+
+		return ( 100 if q <= 0 or q > 100 else q )
+
+	def prepare( self ):
+		pass
+
+	# returns ( error, output, cmd ), phases (if any) receives the wall times measured by the engine
+	def run( self, file, target, phases = None ):
+		raise NotImplementedError
+
+	# several ( file, target ) at once, returns one run() result per item (phases: one dict per item)
+	def batch( self, items, phases = None ):
+		return ( [ self.run( file, target, ( phases[ index ] if phases else None ) ) for index, ( file, target ) in enumerate( items ) ] )
+
+	def sizable( self, target ):
+		global LOSSY
+
+		return ( bool( self.maxsize ) and target.split( '.' )[ -1 ].lower() in LOSSY )
+
+	def fit( self, file, encode ):
+		# encode( quality ) returns the encoded bytes (None on failure), in memory
+		# returns ( quality, data ) of the highest quality within maxsize, ( None, None ) if none fits: 8 encodes at most
+		high = self.quality( file )
+		data = encode( high )
+		if data is None or len( data ) <= self.maxsize:
+			return ( high, data )
+
+		best = ( None, None )
+		low, high = 1, ( high - 1 )
+		while low <= high:
+			quality = ( ( low + high ) // 2 )
+			data = encode( quality )
+			if data is None:
+				return ( quality, None )
+
+			if len( data ) <= self.maxsize:
+				best = ( quality, data )
+				low = ( quality + 1 )
+			else:
+				high = ( quality - 1 )
+
+		return ( best )
+
+	def write( self, target, quality, data, cmd, phases ):
+		# the chosen encoding is the only one written to disk
+		if quality is None:
+			return ( True, 'no quality fits in %d bytes' % self.maxsize, cmd )
+
+		phases[ 'quality' ] = quality
+		try:
+			with open( target, 'wb' ) as f:
+				f.write( data )
+		except OSError as e:
+			return ( True, str( e ), cmd )
+
+		return ( False, 'quality %d' % quality, cmd )
+
+	# returns ( exit code, output, errors ), the process is killed as soon as cancel() is called
+	# errors is None unless split, where stderr is kept apart from the (binary) output
+	# raises Timeout once killed after timeout seconds (by default, that of a photo)
+	def execute( self, cmd, split = False, timeout = None ):
+		global startupinfo
+
+		timeout = ( ( self.timeout if timeout is None else timeout ) or None )
+
+		# own process group: a kill also reaches its delegates, which would otherwise keep the output pipe open
+		process = subprocess.Popen( cmd, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = ( subprocess.PIPE if split else subprocess.STDOUT ), env = self.environment, startupinfo = startupinfo, start_new_session = ( os_name != 'windows' ) )
+		with self.lock:
+			self.processes.add( process )
+			if self.canceled:
+				self.kill( process )
+
+		try:
+			output, errors = process.communicate( timeout = timeout )
+		except subprocess.TimeoutExpired:
+			self.kill( process )
+			process.communicate()
+			raise Timeout( 'timed out after %g s' % timeout )
+		finally:
+			with self.lock:
+				self.processes.discard( process )
+
+		return ( process.returncode, output, errors )
+
+	def kill( self, process ):
+		global os_name
+
+		try:
+			if os_name == 'windows':
+				process.kill()
+			else:
+				os.killpg( process.pid, signal.SIGKILL )
+		except OSError:
+			pass
+
+	def large( self, file ):
+		return ( bool( self.spill ) and cost( file ) > self.budget )
+
+	def limit( self, files ):
+		files = list( files )
+		if any( self.large( file ) for file in files ):
+			return ( self.spill )
+		if not self.budget:
+			return ( [] )
+
+		# a chunk is admitted at the cost of its largest photo, which it holds one at a time
+		size = max( cost( file ) for file in files )
+		return ( [ '-limit', 'memory', '%dMiB' % ( size >> 20 ), '-limit', 'map', '%dMiB' % ( ( size * 2 ) >> 20 ) ] + self.disk )
+
+	# stops the photos in progress, their run() returns an error
+	def cancel( self ):
+		with self.lock:
+			self.canceled = True
+			for process in self.processes:
+				self.kill( process )
+
+	# one decode of file for several ( rendition, target ) (see batch.rendition), largest first; returns ( error, output, cmd )
+	def renditions( self, file, items, phases = None ):
+		raise NotImplementedError
+
+	def close( self ):
+		pass
+
+class CompositeEngine( Engine ):
+	name = 'composite'
+	limited = True
+
+	def prepare( self ):
+		global os_name
+
+		self.composite = resource( 'bin', os_name, 'composite', bin = True )
+		self.prepared = prepare( self.watermark, self.size )
+		self.geometry = self.offset()
+
+		# composite takes a single photo per call, chunks and renditions need convert (or IM7's magick)
+		self.convert = resource( 'bin', os_name, 'convert', bin = True )
+		if not os.path.isfile( self.convert ):
+			self.convert = ( shutil.which( 'convert' ) or shutil.which( 'magick' ) )
+
+	def offset( self, scale = 1. ):
+		x, y = ( round( self.position[ 0 ] * scale ), round( self.position[ 1 ] * scale ) )
+		return ( '%s%d%s%d' % ( ( '+' if x >= 0 else '' ), x, ( '+' if y >= 0 else '' ), y ) )
+
+	def source( self ):
+		# the watermark, as convert arguments: never the prepared MPC, only readable by the bundled composite
+		# that wrote it (convert may be another ImageMagick version or quantum depth)
+		size = self.size
+		if size[ 0 ] and size[ 1 ]:
+			return ( [ self.watermark, '-resize', ( '%dx%d!' % ( size[ 0 ], size[ 1 ] ) ) ] )
+
+		return ( [ self.watermark ] )
+
+	def command( self, file, target, quality = None ):
+		size = self.size
+
+		cmd = [ self.composite ] + self.limit( [ file ] ) + [ '-watermark', ( '%d%%' % self.opacity ), '-gravity', self.gravity, '-geometry', self.geometry, '-quality', str( quality or self.quality( file ) ) ]
+		if self.prepared:
+			cmd.append( self.prepared )
+		elif size[ 0 ] and size[ 1 ]:
+			cmd += [ '(', self.watermark, '-resize', ( '%dx%d!' % ( size[ 0 ], size[ 1 ] ) ), ')' ]
+		else:
+			cmd.append( self.watermark )
+
+		return ( cmd + [ file, target ] )
+
+	def sized( self, file, target, phases ):
+		# the photo is composited once, into a lossless MIFF (any convert reads it, unlike the MPC of composite),
+		# each attempt then only encodes it to stdout, as the format of the target
+		ext = target.split( '.' )[ -1 ].lower()
+		errors = []
+		def attempt( cmd ):
+			try:
+				code, output, error = self.execute( cmd, split = True )
+			except OSError as e:
+				code, output, error = ( None, b'', str( e ).encode( 'utf-8' ) )
+
+			if code or not output or self.canceled:
+				errors.append( error or b'' )
+				return ( None )
+			return ( output )
+
+		# without convert, every attempt composites again
+		folder = ( self.convert and tempfile.mkdtemp( prefix = 'batchSigning-', dir = self.environment.get( 'MAGICK_TEMPORARY_PATH' ) ) )
+		intermediate = ( folder and os.path.join( folder, 'composited.miff' ) )
+		def encode( quality ):
+			if not intermediate:
+				return ( attempt( self.command( file, '%s:-' % ext, quality ) ) )
+			return ( attempt( [ self.convert ] + self.limit( [ file ] ) + [ intermediate, '-quality', str( quality ), '%s:-' % ext ] ) )
+
+		cmd = self.command( file, target )
+		started = time.perf_counter()
+		try:
+			if intermediate:
+				try:
+					code, output, error = self.execute( self.command( file, intermediate ), split = True )
+				except OSError as e:
+					code, output, error = ( None, b'', str( e ).encode( 'utf-8' ) )
+				if code or not os.path.isfile( intermediate ) or self.canceled:
+					errors.append( error or output or b'' )
+
+			quality, data = ( ( None, None ) if errors else self.fit( file, encode ) )
+		finally:
+			if folder:
+				shutil.rmtree( folder, ignore_errors = True )
+		phases.update( { 'process': ( time.perf_counter() - started ), 'exit': ( 1 if errors else 0 ) } )
+
+		if errors:
+			return ( True, ( 'canceled' if self.canceled else str( errors[ -1 ], 'utf-8', 'replace' ) ), cmd )
+		return ( self.write( target, quality, data, cmd, phases ) )
+
+	def run( self, file, target, phases = None ):
+		cmd = self.command( file, target )
+		if self.canceled:
+			return ( True, 'canceled', cmd )
+		if self.sizable( target ):
+			return ( self.sized( file, target, ( {} if phases is None else phases ) ) )
+
+		# decoding, compositing and encoding all happen in the one process
+		started = time.perf_counter()
+		try:
+			code, output, errors = self.execute( cmd )
+			error = bool( code )
+		except OSError as e:
+			error = True
+			output = str( e ).encode( 'utf-8' )
+			code = None
+
+		if self.canceled:
+			error = True
+			output = b'canceled'
+
+		if phases is not None:
+			phases.update( { 'process': ( time.perf_counter() - started ), 'exit': code } )
+
+		return ( error, str( output, 'utf-8', 'replace' ), cmd )
+
+	def renditions( self, file, items, phases = None ):
+		phases = ( {} if phases is None else phases )
+		cmd = [ self.convert ]
+		if not self.convert:
+			return ( True, 'renditions need ImageMagick\'s convert (or the qt engine)', cmd )
+		if self.canceled:
+			return ( True, 'canceled', cmd )
+
+		# the photo is decoded once, each rendition is downscaled from the previous one (before its watermark)
+		cmd += self.limit( [ file ] ) + self.source() + [ '-write', 'mpr:watermark', '+delete' ]
+		cmd += [ '-gravity', self.gravity, '-compose', 'Modulate', '-define', ( 'compose:args=%d' % self.opacity ) ]
+		cmd += [ file, '-write', 'mpr:rendition0', '+delete' ]
+		for index, ( item, target ) in enumerate( items ):
+			try:
+				os.remove( target )
+			except OSError:
+				pass
+
+			resize = ( [ '-resize', ( '%dx%d>' % ( item[ 'size' ], item[ 'size' ] ) ) ] if item[ 'size' ] else [] )
+			cmd += [ '(', ( 'mpr:rendition%d' % index ) ] + resize + [ '-write', ( 'mpr:rendition%d' % ( index + 1 ) ), ')' ]
+
+			mark = [ 'mpr:watermark' ]
+			if item[ 'scale' ] != 1:
+				mark = [ '(', 'mpr:watermark', '-resize', ( '%g%%' % ( item[ 'scale' ] * 100 ) ), ')' ]
+			cmd += mark + [ '-geometry', self.offset( item[ 'scale' ] ), '-composite', '-quality', str( self.quality( target, item[ 'quality' ] ) ), '-write', target, '+delete' ]
+		cmd.append( 'null:' )
+
+		started = time.perf_counter()
+		try:
+			code, output, errors = self.execute( cmd )
+		except OSError as e:
+			code, output = ( None, str( e ).encode( 'utf-8' ) )
+		phases.update( { 'process': ( time.perf_counter() - started ), 'exit': code } )
+
+		if self.canceled:
+			return ( True, 'canceled', cmd )
+
+		# killed (timeout) or failed: whatever was written may be truncated
+		error = ( code != 0 or not all( os.path.isfile( target ) and os.path.getsize( target ) for item, target in items ) )
+		return ( error, str( output, 'utf-8', 'replace' ), cmd )
+
+class BatchEngine( CompositeEngine ):
+	name = 'batch'
+
+	def batch( self, items, phases = None ):
+		# a size target needs one search per photo
+		if not self.convert or len( items ) < 2 or self.maxsize:
+			return ( super( BatchEngine, self ).batch( items, phases ) )
+
+		cmd = [ self.convert ] + self.limit( file for file, target in items ) + self.source()
+		cmd += [ '-write', 'mpr:watermark', '+delete' ]
+		cmd += [ '-gravity', self.gravity, '-geometry', self.geometry, '-compose', 'Modulate', '-define', ( 'compose:args=%d' % self.opacity ) ]
+
+		for file, target in items:
+			try:
+				os.remove( target )
+			except OSError:
+				pass
+
+			cmd += [ '(', file, 'mpr:watermark', '-composite', '-quality', str( self.quality( file ) ), '-write', target, '+delete', ')' ]
+		cmd.append( 'null:' )
+
+		# a hung chunk is killed, its photos are then replayed alone with their own timeout
+		started = time.perf_counter()
+		try:
+			code = self.execute( cmd, timeout = ( self.timeout * len( items ) ) )[ 0 ]
+		except OSError:
+			code = None
+		elapsed = ( time.perf_counter() - started )
+
+		# killed: nothing is replayed, partial outputs are dropped by the caller
+		if self.canceled:
+			return ( [ ( True, 'canceled', cmd ) for item in items ] )
+
+		# a photo without output is replayed alone to get its own diagnostics; after a failed or killed chunk (code
+		# not 0, None on timeout) every photo is, the outputs it left may be truncated
+		results = []
+		for index, ( file, target ) in enumerate( items ):
+			# the process time of a chunk is shared evenly between its photos
+			if phases:
+				phases[ index ].update( { 'process': ( elapsed / len( items ) ), 'exit': code } )
+
+			if code == 0 and os.path.isfile( target ) and os.path.getsize( target ):
+				results.append( ( False, '', cmd ) )
+			else:
+				try:
+					os.remove( target )
+				except OSError:
+					pass
+
+				results.append( self.run( file, target, ( phases[ index ] if phases else None ) ) )
+
+		return ( results )
+
+class QtEngine( Engine ):
+	name = 'qt'
+	formats = { 'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'tiff': 'TIFF', 'tif': 'TIFF', 'webp': 'WEBP' }
+
+	def prepare( self ):
+		qt()
+
+		self.prepared = self.mark()
+		self.writable = [ bytes( item ).decode( 'ascii' ).upper() for item in QtGui.QImageWriter.supportedImageFormats() ]
+
+	def mark( self, scale = 1. ):
+		global cache
+
+		# the watermark only changes with its file, size, opacity and scale: keep its luma shift, as the two layers blend() adds
+		def build( key ):
+			image = QtGui.QImage( self.watermark )
+			if image.isNull():
+				return ( None )
+
+			if self.size[ 0 ] and self.size[ 1 ]:
+				image = image.scaled( self.size[ 0 ], self.size[ 1 ], QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation )
+			if scale != 1:
+				image = image.scaled( max( 1, round( image.width() * scale ) ), max( 1, round( image.height() * scale ) ), QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation )
+			image = image.convertToFormat( QtGui.QImage.Format_ARGB32 )
+
+			# as with ImageMagick, only fully transparent pixels are left out (a neutral gray), the others count whatever their alpha
+			alpha = plane( image.convertToFormat( QtGui.QImage.Format_Alpha8 ), bytes( [ 0 ] + [ 255 ] * 255 ) )
+			image = image.convertToFormat( QtGui.QImage.Format_RGB32 )
+			image.setAlphaChannel( alpha )
+			gray = QtGui.QImage( image.size(), QtGui.QImage.Format_RGB32 )
+			gray.fill( QtGui.QColor( 128, 128, 128 ) )
+			painter = QtGui.QPainter( gray )
+			painter.drawImage( 0, 0, image )
+			painter.end()
+			gray = gray.convertToFormat( QtGui.QImage.Format_Grayscale8 )
+
+			# Modulate's luma offset from the midpoint, at opacity, per gray level (truncated: the neutral gray shifts nothing)
+			shift = [ int( 2.55 * self.opacity * ( int( min( 65535.0, 257.0 * level ) + .5 ) - 32768 ) / 32768.0 ) for level in range( 256 ) ]
+			lighten = plane( gray, bytes( max( 0, value ) for value in shift ) )
+			darken = plane( gray, bytes( max( 0, -value ) for value in shift ) )
+
+			return ( image.width(), image.height(), lighten.convertToFormat( QtGui.QImage.Format_RGB32 ), darken.convertToFormat( QtGui.QImage.Format_RGB32 ) )
+
+		try:
+			key = ( self.name, os.path.realpath( self.watermark ), os.path.getmtime( self.watermark ), tuple( self.size ), self.opacity, scale )
+			return ( cache.get( key, build ) )
+		except OSError:
+			return ( None )
+
+	def encoding( self, file, quality = None ):
+		ext = file.split( '.' )[ -1 ].lower()
+		fmt = self.formats.get( ext, ext.upper() )
+		q = self.quality( file, quality )
+
+		# png: -quality tens digit is the zlib level, Qt maps 0-100 onto levels 9-0
+		if fmt == 'PNG':
+			q = int( 100 - ( min( 9, q // 10 ) * 91 / 9 ) )
+		elif fmt == 'TIFF':
+			q = -1
+
+		return ( fmt, q )
+
+	def run( self, file, target, phases = None ):
+		phases = ( {} if phases is None else phases )
+		fmt, q = self.encoding( target )
+		cmd = [ self.name, self.watermark, file, target ]
+
+		if not self.prepared:
+			return ( True, 'unable to read watermark: %s' % self.watermark, cmd )
+		if fmt not in self.writable:
+			return ( True, 'no Qt image plugin to write %s' % fmt, cmd )
+
+		started = time.perf_counter()
+		if self.canceled:
+			return ( True, 'canceled', cmd )
+
+		image = QtGui.QImage( file )
+		if image.isNull():
+			return ( True, 'unable to decode image: %s' % file, cmd )
+
+		alpha = image.hasAlphaChannel()
+		image = image.convertToFormat( QtGui.QImage.Format_ARGB32 if alpha else QtGui.QImage.Format_RGB32 )
+		phases[ 'decode' ] = ( time.perf_counter() - started )
+
+		started = time.perf_counter()
+		image = self.blend( image, self.prepared )
+		if image is None:
+			return ( True, 'canceled', cmd )
+		phases[ 'composite' ] = ( time.perf_counter() - started )
+
+		started = time.perf_counter()
+		if self.sizable( target ):
+			def encode( quality ):
+				buffer = QtCore.QBuffer()
+				buffer.open( QtCore.QIODevice.WriteOnly )
+				if not image.save( buffer, fmt, quality ):
+					return ( None )
+				return ( bytes( buffer.data() ) )
+
+			quality, data = self.fit( file, encode )
+			phases[ 'encode' ] = ( time.perf_counter() - started )
+			if quality is not None and data is None:
+				return ( True, 'unable to encode image: %s' % target, cmd )
+			return ( self.write( target, quality, data, cmd, phases ) )
+
+		saved = image.save( target, fmt, q )
+		phases[ 'encode' ] = ( time.perf_counter() - started )
+		if not saved:
+			return ( True, 'unable to write image: %s' % target, cmd )
+
+		return ( False, '', cmd )
+
+	def blend( self, image, prepared, scale = 1. ):
+		# returns the watermarked image, None once canceled
+		# ImageMagick's Modulate shifts the luma of each pixel, keeping its hue and chroma: the same shift on every channel,
+		# added (Plus) for the lighter part of the watermark, subtracted (added to the inverted pixels) for the darker one;
+		# Qt composites the whole rectangle in C++, without holding the GIL
+		width, height, lighten, darken = prepared
+		left, top = gravitate( image.width(), image.height(), width, height, self.gravity, ( round( self.position[ 0 ] * scale ), round( self.position[ 1 ] * scale ) ) )
+		area = QtCore.QRect( left, top, width, height ).intersected( image.rect() )
+		if self.canceled:
+			return ( None )
+		if area.isEmpty():
+			return ( image )
+
+		# Plus would also add to the alpha of the photo: set aside, put back afterwards
+		alpha = None
+		if image.hasAlphaChannel():
+			alpha = image.convertToFormat( QtGui.QImage.Format_Alpha8 )
+			image = image.convertToFormat( QtGui.QImage.Format_RGB32 )
+
+		region = image.copy( area )
+		for layer in [ lighten, darken ]:
+			if layer is darken:
+				region.invertPixels()
+
+			painter = QtGui.QPainter( region )
+			painter.setCompositionMode( QtGui.QPainter.CompositionMode_Plus )
+			painter.drawImage( ( left - area.x() ), ( top - area.y() ), layer )
+			painter.end()
+		region.invertPixels()
+
+		painter = QtGui.QPainter( image )
+		painter.setCompositionMode( QtGui.QPainter.CompositionMode_Source )
+		painter.drawImage( area.topLeft(), region )
+		painter.end()
+
+		if alpha is not None:
+			image.setAlphaChannel( alpha )
+
+		return ( image )
+
+	def renditions( self, file, items, phases = None ):
+		phases = ( {} if phases is None else phases )
+		cmd = [ self.name, self.watermark, file ] + [ target for item, target in items ]
+
+		if not self.prepared:
+			return ( True, 'unable to read watermark: %s' % self.watermark, cmd )
+		for item, target in items:
+			if self.encoding( target )[ 0 ] not in self.writable:
+				return ( True, 'no Qt image plugin to write %s' % self.encoding( target )[ 0 ], cmd )
+
+		started = time.perf_counter()
+		if self.canceled:
+			return ( True, 'canceled', cmd )
+
+		image = QtGui.QImage( file )
+		if image.isNull():
+			return ( True, 'unable to decode image: %s' % file, cmd )
+
+		alpha = image.hasAlphaChannel()
+		image = image.convertToFormat( QtGui.QImage.Format_ARGB32 if alpha else QtGui.QImage.Format_RGB32 )
+		phases[ 'decode' ] = ( time.perf_counter() - started )
+		phases.update( { 'composite': 0., 'encode': 0. } )
+
+		# each rendition is downscaled from the previous one, before its watermark (never enlarged)
+		for item, target in items:
+			started = time.perf_counter()
+			size = item[ 'size' ]
+			if size and max( image.width(), image.height() ) > size:
+				image = image.scaled( size, size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation )
+
+			prepared = ( self.prepared if item[ 'scale' ] == 1 else self.mark( item[ 'scale' ] ) )
+			if not prepared:
+				return ( True, 'unable to read watermark: %s' % self.watermark, cmd )
+
+			copy = self.blend( image.copy(), prepared, item[ 'scale' ] )
+			if copy is None:
+				return ( True, 'canceled', cmd )
+			phases[ 'composite' ] += ( time.perf_counter() - started )
+
+			started = time.perf_counter()
+			fmt, q = self.encoding( target, item[ 'quality' ] )
+			saved = copy.save( target, fmt, q )
+			phases[ 'encode' ] += ( time.perf_counter() - started )
+			if not saved:
+				return ( True, 'unable to write image: %s' % target, cmd )
+
+		return ( False, '', cmd )
+
+ENGINES = {
+	CompositeEngine.name:	CompositeEngine,
+	BatchEngine.name:		BatchEngine,
+	QtEngine.name:			QtEngine
+}
+
+def compare( first, second, tolerance = 8 ):
+	# checks two renderings (e.g. one per engine) match within `tolerance` levels per channel
+	qt()
+
+	images = []
+	for file in [ first, second ]:
+		image = QtGui.QImage( file )
+		if image.isNull():
+			return ( False, None )
+		images.append( image.convertToFormat( QtGui.QImage.Format_ARGB32 ) )
+
+	a, b = images
+	if a.size() != b.size():
+		return ( False, None )
+
+	a = a.constBits().asstring( a.sizeInBytes() )
+	b = b.constBits().asstring( b.sizeInBytes() )
+	worst = max( abs( x - y ) for x, y in zip( a, b ) )
+
+	return ( ( worst <= tolerance ), worst )
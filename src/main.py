@@ -1,24 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-DIVIDE = [ 'png', 'tiff' ]
-EXTENSIONS = [ 'png', 'jpeg', 'tiff', 'webp' ]
 CONTROLS_CONFIGS = {
 	'default':	[ 'minimize', 'maximize', 'cross', 10, 26, 86, 38, -( 86 + 15 ) ],
 	'darwin':	[ 'cross', 'minimize', 'maximize', 20, 0, 76, 38, 8 ]
 }
+STEPS = [ 'signature', 'gallery', 'target', 'apply' ]
 
 # built-in
 import os
 import sys
 import json, math
 import threading
-import subprocess
 
 # since PIP
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtWidgets import QFileDialog
 
+# local
+from core import EXTENSIONS, GRAVITIES, os_name, appdata, resource, resource_path, getfilesize, scan, Profile, Progress, Results
+
 # more
 try:
 	import win32api
@@ -28,123 +29,56 @@ except:
 	def longpath( path ):
 		return ( path )
 
-# platform
-os_name = sys.platform
-os_name = ( 'windows' if os_name.startswith( 'win' ) else os_name )
-os_name = ( 'linux' if os_name.startswith( 'linux' ) else os_name )
-
-# appdata
-appdata = os.getenv( 'APPDATA', None )
-if not appdata:
-	appdata = os.path.join( os.getenv( 'HOME' ), '.config' )
-appdata = os.path.join( appdata, 'batchSigning' )
-
-# fix subprocess poped window
-startupinfo = None
-if sys.platform == 'win32':
-	startupinfo = subprocess.STARTUPINFO()
-	startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-def exec_path( relative_path = '' ):
-	if getattr( sys, 'frozen', False ) and getattr( sys, '_MEIPASS', False ):
-		tmp = os.path.dirname( sys.executable )
-	else:
-		tmp = os.path.dirname( os.path.realpath( __file__ ) )
-
-	return ( os.path.join( tmp, relative_path ) )
-
-def resource_path( relative_path = '' ):
-	if getattr( sys, '_MEIPASS', False ):
-		tmp = sys._MEIPASS
-	else:
-		tmp = os.path.dirname( os.path.realpath( __file__ ) )
-
-	return ( os.path.join( tmp, relative_path ) )
-
-def resource( *args, **kwargs ):
-	global os_name
-
-	path = os.path.join( *args )
-	if 'root' not in kwargs or not kwargs[ 'root' ]:
-		path = os.path.join( 'resources', path )
-	if 'bin' in kwargs and kwargs[ 'bin' ] and os_name == 'windows':
-		path += '.exe'
-
-	return ( resource_path( path ) )
-
-def getfilesize( file ):
-	filesize = str( os.path.getsize( file ) )
-
-	lencut = 0
-	lensize = len( filesize )
-	if ( lensize > 12 ):
-		lencut = 12
-	elif ( lensize > 9 ):
-		lencut = 9
-	elif ( lensize > 6 ):
-		lencut = 6
-	elif ( lensize > 3 ):
-		lencut = 3
-
-	lensuffix = { 0: '', 3: 'K', 6: 'M', 9: 'G', 12: 'T' }
-	if lencut:
-		filesize = filesize[ 0:-( lencut ) ] + '.' + filesize[ -( lencut ):-( lencut - 1 ) ]
-	filesize += ' ' + lensuffix[ lencut ] + 'o'
-
-	return ( filesize )
-
-def process( files, watermark, target, quality = 100, opacity = 100, gravity = 'Center', position = ( 0, 0 ), size = ( 0, 0 ), stopevent = None, sigprogress = None, sigcanceled = None, sigfinished = None ):
-	global DIVIDE, os_name, startupinfo
-
-	composite = resource( 'bin', os_name, 'composite', bin = True )
-
-	opacity = ( '%d%%' % opacity )
-
-	geometry = '%s%d' % ( ( '+' if position[ 0 ] >= 0 else '' ), position[ 0 ] )
-	geometry += '%s%d' % ( ( '+' if position[ 1 ] >= 0 else '' ), position[ 1 ] )
-
-	resume = [ [], [], [] ]
-	total = len( files )
-	for index, file in enumerate( files ):
-		if stopevent and stopevent.is_set():
-			if sigcanceled and not len( resume[ 2 ] ):
-				sigcanceled()
-
-			resume[ 2 ].append( file )
-			continue
-		elif sigprogress:
-			sigprogress( index, total, file, None, None, None )
-
-		q = quality
-		if file.split( '.' )[ -1 ].lower() in DIVIDE:
-			q = round( q / 10 )
-		q = str( 100 if q <= 0 or q > 100 else q )
-
-		t = os.path.join( target, os.path.basename( file ) )
-
-		cmd = [ composite, '-watermark', opacity, '-gravity', gravity, '-geometry', geometry, '-quality', q ]
-		if size[ 0 ] and size[ 1 ]:
-			cmd += [ '(', watermark, '-resize', ( '%dx%d!' % ( size[ 0 ], size[ 1 ] ) ), ')' ]
-		else:
-			cmd.append( watermark )
-		cmd += [ file, t ]
-
-		error = False
-		output = False
+class Pixmaps( object ):
+	# interface assets, decoded once and scaled once per ( resource, size, device pixel ratio )
+	def __init__( self ):
+		self.images = {}
+		self.items = {}
+
+	def image( self, path ):
+		image = self.images.get( path )
+		if image is None:
+			image = QtGui.QImage( resource( path ) )
+			self.images[ path ] = image
+
+		return ( image )
+
+	def get( self, path, width = 0, height = 0, ratio = 1. ):
+		key = ( path, width, height, ratio )
+		pixmap = self.items.get( key )
+		if pixmap is None:
+			image = self.image( path )
+			if not image.isNull():
+				if width and height:
+					image = image.scaled( round( width * ratio ), round( height * ratio ), QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation )
+				elif height:
+					image = image.scaledToHeight( round( height * ratio ), QtCore.Qt.SmoothTransformation )
+				elif width:
+					image = image.scaledToWidth( round( width * ratio ), QtCore.Qt.SmoothTransformation )
+
+			pixmap = QtGui.QPixmap.fromImage( image )
+			pixmap.setDevicePixelRatio( ratio )
+			self.items[ key ] = pixmap
+
+		return ( pixmap )
+
+	def preload( self, ratio = 1. ):
+		global CONTROLS_CONFIGS, STEPS
+
+		# only what the first page paints, the rest (logo, window icon ...) is decoded on first use
+		mode = ( os_name if os_name in CONTROLS_CONFIGS.keys() else 'default' )
 		try:
-			output = subprocess.check_output( cmd, stdin = subprocess.PIPE, stderr = subprocess.STDOUT, env = os.environ, startupinfo = startupinfo )
-			resume[ 0 ].append( file )
-		except subprocess.CalledProcessError as e:
-			error = True
-			output = e.output
-			resume[ 1 ].append( file )
+			controls = [ os.path.join( 'controls', file ) for file in os.listdir( resource( 'controls' ) ) if ( '_%s' % mode ) in file ]
+		except OSError:
+			controls = []
+
+		for path in ( controls + [ '%s.png' % step for step in STEPS ] ):
+			self.image( path )
 
-		output = str( output, 'utf-8' )
-		if sigprogress:
-			sigprogress( index, total, file, cmd, error, output )
+		for gravity in GRAVITIES:
+			self.get( os.path.join( 'gravity', '%s.png' % gravity.lower() ), 0, Gravity.thumbnail, ratio )
 
-	if sigfinished:
-		sigfinished( ( stopevent and stopevent.is_set() ), *resume )
+pixmaps = Pixmaps()
 
 class Image( QtWidgets.QLabel ):
 	def __init__( self, name, width, height, mouseover = False, callback = None, path = None, parent = None ):
@@ -183,23 +117,24 @@ class Image( QtWidgets.QLabel ):
 		painter = QtGui.QPainter( self )
 		painter.setRenderHints( ( QtGui.QPainter.Antialiasing | QtGui.QPainter.SmoothPixmapTransform ), True )
 
-		image = QtGui.QPixmap.fromImage( QtGui.QImage( resource( '%s.png' % file ) ) )
+		size = self.width()
+		image = pixmaps.get( '%s.png' % file, size, size, self.devicePixelRatioF() )
 		if opacity:
 			painter.setOpacity( 1 if white else .3 )
 
 		center = QtCore.QPoint( ( self.width() / 2 ), ( self.height() / 2 ) )
 		painter.translate( center )
+		painter.translate( -( size / 2 ), -( size / 2 ) )
 
-		painter.scale( 1 * ( self.width() / image.width() ), 1 * ( self.width() / image.height() ) )
-		painter.translate( -( image.width() / 2 ), -( image.height() / 2 ) )
-
-		painter.drawPixmap( 0, 0, image.width(), image.height(), image )
+		painter.drawPixmap( 0, 0, size, size, image )
 
 	def mousePressEvent( self, event ):
 		if self.callback:
 			self.callback( self, event )
 
 class Gravity( QtWidgets.QLabel ):
+	thumbnail = 115
+
 	def __init__( self, parent = None ):
 		super( Gravity, self ).__init__( parent )
 
@@ -215,8 +150,7 @@ class Gravity( QtWidgets.QLabel ):
 		return ( self._relative )
 
 	def reload( self ):
-		pixmap = QtGui.QPixmap( resource( self.file() ) )
-		self.setPixmap( pixmap.scaledToHeight( 115, QtCore.Qt.SmoothTransformation ) )
+		self.setPixmap( pixmaps.get( self.file(), 0, self.thumbnail, self.devicePixelRatioF() ) )
 
 	def setGravity( self, gravity ):
 		gravity = gravity.lower()
@@ -279,10 +213,99 @@ class Gravity( QtWidgets.QLabel ):
 
 		self.setRelative( y - 1, x - 1 )
 
+class Preview( QtCore.QObject ):
+	sigready = QtCore.pyqtSignal( str, object, str )
+
+	def __init__( self, parent = None ):
+		super( Preview, self ).__init__( parent )
+
+		self.request = None
+		self.condition = threading.Condition()
+
+		self.thread = threading.Thread( target = self.loop, daemon = True )
+		self.thread.start()
+
+	def load( self, file, width, height ):
+		# only the latest request matters, a pending one is simply replaced
+		with self.condition:
+			self.request = ( file, width, height )
+			self.condition.notify()
+
+	def loop( self ):
+		while True:
+			with self.condition:
+				while not self.request:
+					self.condition.wait()
+
+				file, width, height = self.request
+				self.request = None
+
+			# decoded straight at preview size (jpeg scales while decoding)
+			reader = QtGui.QImageReader( file )
+			size = reader.size()
+			if size.isValid():
+				size.scale( width, height, QtCore.Qt.KeepAspectRatio )
+				reader.setScaledSize( size )
+			image = reader.read()
+
+			try:
+				filesize = getfilesize( file )
+			except OSError:
+				filesize = ''
+
+			self.sigready.emit( file, image, filesize )
+
+class Report( QtCore.QAbstractListModel ):
+	# the photos of a batch (see core.Results) for a QListView: rows are fetched by blocks as the list
+	# scrolls and their paths only decoded once painted
+	block = 1000
+	labels = [ 'done', 'error', 'ignored', 'up to date' ]
+	colors = [ None, QtGui.QColor( 231, 76, 60 ), QtGui.QColor( 170, 178, 189 ), None ]
+
+	def __init__( self, parent = None ):
+		super( Report, self ).__init__( parent )
+
+		self.view = None
+		self.loaded = 0
+
+	def load( self, view ):
+		self.beginResetModel()
+		self.view = view
+		self.loaded = 0
+		self.endResetModel()
+
+	def rowCount( self, parent = QtCore.QModelIndex() ):
+		return ( 0 if parent.isValid() else self.loaded )
+
+	def canFetchMore( self, parent ):
+		return ( not parent.isValid() and self.view is not None and self.loaded < len( self.view ) )
+
+	def fetchMore( self, parent ):
+		count = min( self.block, ( len( self.view ) - self.loaded ) )
+		self.beginInsertRows( QtCore.QModelIndex(), self.loaded, ( self.loaded + count - 1 ) )
+		self.loaded += count
+		self.endInsertRows()
+
+	def data( self, index, role = QtCore.Qt.DisplayRole ):
+		if not index.isValid() or self.view is None:
+			return ( None )
+
+		row = self.view.row( index.row() )
+		if role == QtCore.Qt.DisplayRole:
+			return ( os.path.basename( self.view.results.path( row ) ) )
+		elif role == QtCore.Qt.ToolTipRole:
+			return ( '%s (%s)' % ( self.view.results.path( row ), self.labels[ self.view.results.status( row ) ] ) )
+		elif role == QtCore.Qt.UserRole:
+			return ( self.view.results.output( row ) )
+		elif role == QtCore.Qt.ForegroundRole:
+			return ( self.colors[ self.view.results.status( row ) ] )
+
+		return ( None )
+
 class Window( QtWidgets.QMainWindow ):
 	sigcanceled = QtCore.pyqtSignal()
-	sigfinished = QtCore.pyqtSignal( bool, list, list, list )
-	sigprogress = QtCore.pyqtSignal( int, int, str, object, object, object )
+	sigfinished = QtCore.pyqtSignal( bool, object, object, object, object )
+	sigprogress = QtCore.pyqtSignal( int, int, int, str, list )
 
 	def __init__( self, parent = None ):
 		super( Window, self ).__init__( parent )
@@ -292,7 +315,10 @@ class Window( QtWidgets.QMainWindow ):
 		self.paths = [ '', '', '' ]
 		self.steps = [ [], [], [], [] ]
 		self.resume = ''
+		self.results = None
+		self.painted = None
 		self.started = False
+		self.processPage = None
 		self.waiting = False
 		self.settings = {}
 		self.sigcanceled.connect( self.canceled )
@@ -301,10 +327,10 @@ class Window( QtWidgets.QMainWindow ):
 		self.stopthread = threading.Event()
 
 	def setup( self ):
-		global EXTENSIONS, CONTROLS_CONFIGS, appdata
+		global EXTENSIONS, CONTROLS_CONFIGS, STEPS, appdata
 
 		icon = QtGui.QIcon()
-		icon.addPixmap( QtGui.QPixmap( resource( 'icon.png' ) ), QtGui.QIcon.Normal, QtGui.QIcon.Off )
+		icon.addPixmap( pixmaps.get( 'icon.png' ), QtGui.QIcon.Normal, QtGui.QIcon.Off )
 		self.setWindowIcon( icon )
 		self.setWindowTitle( 'batchSigning' )
 		self.setWindowFlags( QtCore.Qt.FramelessWindowHint | QtCore.Qt.WindowMaximizeButtonHint )
@@ -381,7 +407,7 @@ class Window( QtWidgets.QMainWindow ):
 		ilayout.setSpacing( 38 )
 		layout.addWidget( icons )
 
-		for index, item in enumerate( [ 'signature', 'gallery', 'target', 'apply' ] ):
+		for index, item in enumerate( STEPS ):
 			if index:
 				separator = QtWidgets.QWidget()
 				separator.setProperty( 'cssClass', 'separator' )
@@ -649,7 +675,50 @@ class Window( QtWidgets.QMainWindow ):
 		mlayout.addWidget( sheight, 0, 4 )
 		self.settings[ 'height' ] = sheight
 
-		### Process
+		### Page
+		self.central( self.defaultPage )
+
+		### Values
+		data = {
+			'gravity':	'center',
+			'quality':	100,
+			'opacity':	100,
+			'x':		0,
+			'y':		0,
+			'opacity':	100,
+			'resize':	False,
+			'width':	100,
+			'height':	100
+		}
+
+		try:
+			config = os.path.join( appdata, 'settings.json' )
+			if os.path.isfile( config ):
+				with open( config, 'r', encoding = 'utf-8' ) as f:
+					loaddata = json.loads( f.read() )
+					for key in loaddata.keys():
+						value = loaddata[ key ]
+						if key in data.keys() and type( value ) is type( data[ key ] ):
+							data[ key ] = value
+		except:
+			pass
+
+		for key in data.keys():
+			item = self.settings[ key ]
+
+			method = 'value'
+			if type( item ) is Gravity:
+				method = 'gravity'
+			elif type( item ) is QtWidgets.QCheckBox:
+				method = 'checked'
+
+			getattr( item, 'set%s' % method.capitalize() )( data[ key ] )
+
+		self.change()
+		self.update()
+
+	# the process page is only built the first time a batch starts
+	def setupprocess( self ):
 		self.processPage = QtWidgets.QWidget( self )
 		self.processPage.setObjectName( 'processPage' )
 
@@ -678,6 +747,49 @@ class Window( QtWidgets.QMainWindow ):
 		preview.setObjectName( 'preview' )
 		scroll.setWidget( preview )
 
+		## Results (once finished)
+		results = QtWidgets.QWidget()
+		results.setObjectName( 'results' )
+		results.setFixedHeight( 320 )
+		results.hide()
+		rlayout = QtWidgets.QVBoxLayout( results )
+		rlayout.setContentsMargins( 0, 0, 0, 0 )
+		rlayout.setSpacing( 10 )
+		layout.addWidget( results, 1, 0 )
+
+		counts = QtWidgets.QLabel()
+		counts.setTextFormat( QtCore.Qt.RichText )
+		counts.setWordWrap( True )
+		counts.setObjectName( 'counts' )
+		rlayout.addWidget( counts )
+
+		self.filter = QtWidgets.QComboBox()
+		self.filter.setObjectName( 'filter' )
+		self.filter.currentIndexChanged.connect( self.filtered )
+		rlayout.addWidget( self.filter )
+
+		# only the visible rows are laid out and painted
+		self.report = Report( self )
+		files = QtWidgets.QListView()
+		files.setUniformItemSizes( True )
+		files.setEditTriggers( QtWidgets.QAbstractItemView.NoEditTriggers )
+		files.setObjectName( 'files' )
+		files.setModel( self.report )
+		rlayout.addWidget( files )
+
+		# what the engine said about the selected photo
+		details = QtWidgets.QPlainTextEdit()
+		details.setReadOnly( True )
+		details.setFixedHeight( 70 )
+		details.setObjectName( 'details' )
+		rlayout.addWidget( details )
+
+		files.selectionModel().currentChanged.connect( lambda current, previous: details.setPlainText( current.data( QtCore.Qt.UserRole ) or '' ) )
+		self.report.modelReset.connect( details.clear )
+
+		self.scroll = scroll
+		self.panel = results
+
 		## Infos
 		infos = QtWidgets.QWidget()
 		infos.setContentsMargins( 0, 0, 0, 0 )
@@ -728,57 +840,19 @@ class Window( QtWidgets.QMainWindow ):
 		self.bclose.clicked.connect( lambda: self.stopprocess( True ) )
 		ilayout.addWidget( self.bclose )
 
+		self.preview = Preview( self )
+		self.preview.sigready.connect( self.previewed )
+		self.previewing = None
+
 		self.infos = {
 			'progressbar':	progressbar,
 			'preview':	preview,
+			'counts':	counts,
 			'filename':	filename,
 			'filesize':	filesize,
 			'states':	states
 		}
 
-		### Header on top
-		self.central( self.processPage )
-		self.central( self.defaultPage )
-
-		### Values
-		data = {
-			'gravity':	'center',
-			'quality':	100,
-			'opacity':	100,
-			'x':		0,
-			'y':		0,
-			'opacity':	100,
-			'resize':	False,
-			'width':	100,
-			'height':	100
-		}
-
-		try:
-			config = os.path.join( appdata, 'settings.json' )
-			if os.path.isfile( config ):
-				with open( config, 'r', encoding = 'utf-8' ) as f:
-					loaddata = json.loads( f.read() )
-					for key in loaddata.keys():
-						value = loaddata[ key ]
-						if key in data.keys() and type( value ) is type( data[ key ] ):
-							data[ key ] = value
-		except:
-			pass
-
-		for key in data.keys():
-			item = self.settings[ key ]
-
-			method = 'value'
-			if type( item ) is Gravity:
-				method = 'gravity'
-			elif type( item ) is QtWidgets.QCheckBox:
-				method = 'checked'
-
-			getattr( item, 'set%s' % method.capitalize() )( data[ key ] )
-
-		self.change()
-		self.update()
-
 	def central( self, widget ):
 		layout = self.centralWidget.layout()
 
@@ -814,75 +888,91 @@ class Window( QtWidgets.QMainWindow ):
 		self.bcancel.setText( 'Cancel' )
 		self.bclose.show()
 
+		self.previewing = None
 		self.infos[ 'filename' ].setText( '' )
 		self.infos[ 'filesize' ].setText( '' )
 		self.infos[ 'preview' ].setPixmap( QtGui.QPixmap() )
-		self.infos[ 'preview' ].setAlignment( QtCore.Qt.AlignCenter )
-		self.infos[ 'preview' ].setText( ( self.resume or '' ).replace( '\n', '<br>' ) )
+		self.infos[ 'counts' ].setText( self.resume or '' )
+
+		# the counts right away, the photos of the selected status as the list scrolls
+		self.filter.blockSignals( True )
+		self.filter.clear()
+		if self.results is not None:
+			for label, status in [ ( 'Errors', Results.ERRORS ), ( 'Ignored', Results.IGNORED ), ( 'Done', Results.SUCCESS ), ( 'Duplicates', Results.DUPLICATES ), ( 'Already up to date', Results.SKIPPED ), ( 'All', None ) ]:
+				count = self.results.count( status )
+				if count:
+					self.filter.addItem( '%s (%d)' % ( label, count ), status )
+		self.filter.blockSignals( False )
+		self.filtered()
+
+		self.scroll.hide()
+		self.panel.show()
 
 		self.waiting = False
 
-	def finished( self, user = False, success = None, errors = None, ignored = None ):
+	def filtered( self, *args ):
+		if self.results is None or self.filter.currentIndex() < 0:
+			self.report.load( None )
+		else:
+			self.report.load( self.results.view( self.filter.currentData() ) )
+
+	def finished( self, user = False, success = None, errors = None, ignored = None, skipped = None ):
+		# counts only, never the files themselves: a batch may have 100k of them
 		resume = ''
 		template = '<div align="left" style="margin: 10px 10px 0px; font-weight: bold; text-decoration: underline;">%s:</div><div align="center" style="margin: 0px 20px;">%s</div>'
 
-		if len( ignored ):
-			files = ''
-			for index, file in enumerate( ignored ):
-				files += '%s%s' % ( ( ', ' if index else '' ), os.path.basename( file ) )
-			resume += template % ( 'Ignored files', files )
+		duplicates = ( errors.results.count( Results.DUPLICATES ) if hasattr( errors, 'results' ) else 0 )
+		for label, count in [ ( 'Already up to date', len( skipped ) ), ( 'Duplicates (not rendered again)', duplicates ), ( 'Ignored files', len( ignored ) ), ( 'Errors encountered', len( errors ) ) ]:
+			if count:
+				resume += template % ( label, '%d file%s' % ( count, ( 's' if count > 1 else '' ) ) )
 
-		if len( errors ):
-			files = ''
-			for index, file in enumerate( errors ):
-				files += '%s%s' % ( ( ', ' if index else '' ), os.path.basename( file ) )
-			resume += template % ( 'Errors encountered', files )
+		if not len( ignored ) and not len( errors ):
+			resume += 'Everything went smoothly !'
 
-		self.resume = ( resume or 'Everything went smoothly !' )
+		self.resume = resume
+		self.results = getattr( errors, 'results', None )
 		if not user:
 			self.stopprocess( user = user )
 
-	def progress( self, index, total, file = '', cmd = None, error = None, output = None ):
+	def progress( self, index, done, total, file = '', errors = None ):
 		if total:
 			self.infos[ 'progressbar' ].setRange( 0, total )
-			self.infos[ 'progressbar' ].setValue( index )
+			self.infos[ 'progressbar' ].setValue( done )
 
-		if error is None:
-			length = max( 3, len( str( total ) ) )
-			template = '<pre>[ <span style="font-size: %dpx;"><span style="color: rgb( 231, 76, 60 );">%s</span> %s / %s</span> ]</pre>'
+		self.errors += len( errors or [] )
 
-			fontsize = 10
-			fontsizes = [ 17, 17, 17, 14, 12 ]
-			if length <= len( fontsizes ):
-				fontsize = fontsizes[ length - 1 ]
+		length = max( 3, len( str( total ) ) )
+		template = '<pre>[ <span style="font-size: %dpx;"><span style="color: rgb( 231, 76, 60 );">%s</span> %s / %s</span> ]</pre>'
 
-			text = template % (
-				fontsize,
-				str( self.errors ).ljust( length, ' ' ),
-				str( index + 1 ).rjust( length, '0' ),
-				str( total ).rjust( length, '0' )
-			)
+		fontsize = 10
+		fontsizes = [ 17, 17, 17, 14, 12 ]
+		if length <= len( fontsizes ):
+			fontsize = fontsizes[ length - 1 ]
 
-			self.infos[ 'states' ].setText( text )
+		text = template % (
+			fontsize,
+			str( self.errors ).ljust( length, ' ' ),
+			str( index + 1 ).rjust( length, '0' ),
+			str( total ).rjust( length, '0' )
+		)
 
-			if file:
-				self.infos[ 'filename' ].setText( os.path.basename( file ) )
-				self.infos[ 'filesize' ].setText( getfilesize( file ) )
+		self.infos[ 'states' ].setText( text )
 
-				pixmap = QtGui.QPixmap( file )
-				if pixmap and not pixmap.isNull():
-					width = self.infos[ 'preview' ].width()
-					height = self.infos[ 'preview' ].height()
+		if file:
+			self.infos[ 'filename' ].setText( os.path.basename( file ) )
 
-					pixmap = pixmap.scaled( width, height, ( QtCore.Qt.KeepAspectRatio | QtCore.Qt.SmoothTransformation ) )
-					self.infos[ 'preview' ].setPixmap( pixmap )
-		else:
-			self.infos[ 'progressbar' ].setValue( index + 1 )
+			if file != self.previewing:
+				self.previewing = file
+				self.preview.load( file, self.infos[ 'preview' ].width(), self.infos[ 'preview' ].height() )
+
+	def previewed( self, file, image, filesize ):
+		# a late preview of a file the progress already moved past is dropped
+		if file != self.previewing:
+			return
 
-			#print( 'cmd:', cmd )
-			if error:
-				self.errors += 1
-				#print( 'output:', output )
+		self.infos[ 'filesize' ].setText( filesize )
+		if image and not image.isNull():
+			self.infos[ 'preview' ].setPixmap( QtGui.QPixmap.fromImage( image ) )
 
 	def define( self, step ):
 		if step >= 0 and step < len( self.steps ):
@@ -940,19 +1030,8 @@ class Window( QtWidgets.QMainWindow ):
 				except:
 					pass
 
-				exts = []
-				for ext in EXTENSIONS:
-					exts.append( ext )
-					if ext == 'jpeg':
-						exts.append( 'jpg' )
-
-				files = []
-				gallery = self.paths[ 1 ]
-				for file in os.listdir( gallery ):
-					file = os.path.join( gallery, file )
-					ext = file.split( '.' )[ -1 ].lower()
-					if os.path.isfile( file ) and ext in exts:
-						files.append( file )
+				# photos are handed to the workers while the gallery is still being walked
+				files = scan( self.paths[ 1 ], skip = [ self.paths[ 2 ] ] )
 
 				quality = self.settings[ 'quality' ].value()
 				opacity = self.settings[ 'opacity' ].value()
@@ -962,18 +1041,42 @@ class Window( QtWidgets.QMainWindow ):
 				if bool( self.settings[ 'resize' ].checkState() ):
 					size = ( self.settings[ 'width' ].value(), self.settings[ 'height' ].value() )
 
+				# per file events are coalesced, the interface follows at most 10 times per second
+				progress = Progress( self.sigprogress.emit, rate = 10 )
+				def finished( *args ):
+					progress.flush()
+					self.sigfinished.emit( *args )
+
 				args = ( files, self.paths[ 0 ], self.paths[ 2 ] )
 				kwargs = {
+					'gallery':		self.paths[ 1 ],
 					'quality':		quality,
 					'opacity':		opacity,
 					'gravity':		gravity,
 					'position':		position,
 					'size':			size,
 					'stopevent':	self.stopthread,
-					'sigfinished':	self.sigfinished.emit,
-					'sigprogress':	self.sigprogress.emit,
+					'sigfinished':	finished,
+					'sigprogress':	progress,
 				}
 
+				# loads the engines on the first batch only
+				from batch import Job, process
+
+				# an interrupted batch of the same photos goes on where it stopped, with its own settings
+				job = Job.load( self.paths[ 2 ] )
+				if job and job.get( 'state' ) != 'finished' and job.get( 'watermark' ) == os.path.abspath( self.paths[ 0 ] ) and job.get( 'gallery' ) == os.path.abspath( self.paths[ 1 ] ):
+					answer = QtWidgets.QMessageBox.question( self, 'batchSigning', 'An interrupted batch was found in the target folder.\nResume it where it stopped, with its settings ?', ( QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No ), QtWidgets.QMessageBox.Yes )
+					if answer == QtWidgets.QMessageBox.Yes:
+						settings = job.get( 'settings', {} )
+						for key in [ 'quality', 'opacity', 'gravity', 'workers', 'engine', 'chunk', 'megapixels', 'incremental', 'checksum', 'budget', 'disk', 'scratch', 'maxsize', 'renditions', 'timeout', 'retries', 'dedupe', 'prefetch', 'prefetchsize', 'prefetchcache' ]:
+							if key in settings:
+								kwargs[ key ] = settings[ key ]
+						for key in [ 'position', 'size' ]:
+							if key in settings:
+								kwargs[ key ] = tuple( settings[ key ] )
+						kwargs[ 'job' ] = job.get( 'id' )
+
 				self.errors = 0
 				self.startprocess()
 
@@ -1001,8 +1104,11 @@ class Window( QtWidgets.QMainWindow ):
 
 	def startprocess( self ):
 		if not self.started:
+			if not self.processPage:
+				self.setupprocess()
+
 			self.started = True
-			self.progress( 0, 0 )
+			self.progress( 0, 0, 0 )
 			self.central( self.processPage )
 
 	def stopprocess( self, user = False ):
@@ -1030,7 +1136,10 @@ class Window( QtWidgets.QMainWindow ):
 				self.stopthread.clear()
 
 				self.infos[ 'preview' ].setText( '' )
-				self.infos[ 'preview' ].setAlignment( QtCore.Qt.AlignBottom | QtCore.Qt.AlignCenter )
+				self.report.load( None )
+				self.results = None
+				self.panel.hide()
+				self.scroll.show()
 
 			self.waiting = False
 
@@ -1047,22 +1156,48 @@ class Window( QtWidgets.QMainWindow ):
 				self.drag = drag
 				event.accept()
 
+	def paintEvent( self, event ):
+		super( Window, self ).paintEvent( event )
+
+		if self.painted:
+			painted, self.painted = ( self.painted, None )
+			painted()
+
 	def closeEvent( self, event ):
 		if not self.started or not self.bcancel.isVisible():
 			event.accept()
 		else:
 			event.ignore()
 
-def launch():
+def launch( started = None ):
+	profile = Profile( started )
+	if started is not None:
+		profile.mark( 'imports' )
+
 	os.chdir( resource_path() )
 	app = QtWidgets.QApplication( [] )
+	profile.mark( 'application' )
 
-	style = ''
 	with open( resource( 'style.qss', root = True ), 'r', encoding = 'utf-8', errors = 'ignore' ) as f:
 		app.setStyleSheet( f.read() )
+	profile.mark( 'stylesheet' )
+
+	pixmaps.preload( app.devicePixelRatio() )
+	profile.mark( 'pixmaps' )
 
 	win = Window()
 	win.setup()
+	profile.mark( 'widgets' )
+
+	# --startup-profile: print the timings of each phase once the window is drawn, then quit
+	if '--startup-profile' in sys.argv:
+		def painted():
+			profile.mark( 'first paint' )
+			profile.report()
+			QtCore.QTimer.singleShot( 0, app.quit )
+
+		win.painted = painted
+
 	win.show()
 
 	qtRectangle = win.frameGeometry()
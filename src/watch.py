@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# built-in
+import os
+import time
+import errno
+import select
+import struct
+import threading
+
+# local
+from core import match, scan, selected
+from batch import Batch
+
+# inotify (linux), polling with os.scandir elsewhere
+try:
+	import ctypes, ctypes.util
+
+	libc = ctypes.CDLL( ( ctypes.util.find_library( 'c' ) or 'libc.so.6' ), use_errno = True )
+	libc.inotify_init1
+	libc.inotify_add_watch
+except ( OSError, AttributeError ):
+	libc = None
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+
+class Inotify( object ):
+	mask = ( IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY )
+
+	def __init__( self ):
+		self.fd = libc.inotify_init1( IN_CLOEXEC )
+		if self.fd < 0:
+			raise OSError( ctypes.get_errno(), 'inotify_init1' )
+
+		self.folders = {}
+
+	def add( self, folder ):
+		wd = libc.inotify_add_watch( self.fd, os.fsencode( folder ), self.mask )
+		if wd >= 0:
+			self.folders[ wd ] = folder
+
+		return ( wd >= 0 )
+
+	# yields ( path, mask ), path is None when events were lost
+	def read( self, timeout ):
+		try:
+			ready = select.select( [ self.fd ], [], [], timeout )[ 0 ]
+		except InterruptedError:
+			return
+		if not ready:
+			return
+
+		try:
+			data = os.read( self.fd, 65536 )
+		except OSError as e:
+			if e.errno in [ errno.EAGAIN, errno.EINTR ]:
+				return
+			raise
+
+		offset = 0
+		while offset + 16 <= len( data ):
+			wd, mask, cookie, length = struct.unpack_from( 'iIII', data, offset )
+			name = data[ ( offset + 16 ):( offset + 16 + length ) ].rstrip( b'\0' )
+			offset += ( 16 + length )
+
+			if mask & IN_Q_OVERFLOW:
+				yield ( None, mask )
+			elif mask & IN_IGNORED:
+				self.folders.pop( wd, None )
+			elif wd in self.folders and name:
+				yield ( os.path.join( self.folders[ wd ], os.fsdecode( name ) ), mask )
+
+	def close( self ):
+		os.close( self.fd )
+
+def folders( root, gallery, depth = None, exclude = None, skip = None ):
+	skip = [ os.path.realpath( item ) for item in ( skip or [] ) ]
+
+	stack = [ root ]
+	while stack:
+		folder = stack.pop()
+		relative = os.path.relpath( folder, gallery ).replace( os.sep, '/' )
+		if relative != '.':
+			if relative.startswith( '../' ) or ( depth is not None and relative.count( '/' ) >= depth + 1 ):
+				continue
+			if ( exclude and match( relative, exclude ) ) or os.path.realpath( folder ) in skip:
+				continue
+
+		yield ( folder )
+
+		try:
+			with os.scandir( folder ) as entries:
+				stack.extend( entry.path for entry in entries if entry.is_dir( follow_symlinks = False ) )
+		except OSError:
+			pass
+
+def watch( watermark, gallery, target, settle = 2., interval = 1., polling = False, depth = None, include = None, exclude = None, stopevent = None, sigprogress = None, **kwargs ):
+	# one warm pool and one prepared watermark for the whole session
+	stopevent = ( stopevent or threading.Event() )
+	batch = Batch( watermark, target, gallery = gallery, stopevent = stopevent, sigprogress = sigprogress, **kwargs )
+	batch.start()
+
+	skip = [ target ]
+	options = ( depth, include, exclude, skip )
+
+	notify = None
+	if not polling and libc:
+		try:
+			notify = Inotify()
+		except OSError:
+			notify = None
+
+	known = {}
+	def stat( file ):
+		try:
+			info = os.stat( file )
+			return ( info.st_size, info.st_mtime_ns )
+		except OSError:
+			return ( None )
+
+	# ( path, signature ) of every photo, from the directory listing rather than a stat by path
+	def listed():
+		for entry in scan( gallery, *options, entries = True ):
+			try:
+				info = entry.stat()
+			except OSError:
+				continue
+			yield ( entry.path, ( info.st_size, info.st_mtime_ns ) )
+
+	def watched( root ):
+		for folder in folders( root, gallery, depth, exclude, skip ):
+			notify.add( folder )
+
+	# catch up with what arrived while nobody was watching, the manifest skips the rest
+	if notify:
+		watched( gallery )
+		batch.feed( scan( gallery, *options ) )
+	else:
+		known.update( listed() )
+		batch.feed( list( known.keys() ) )
+
+	# path: [ signature, since, closed ], a file is ready once closed by its writer (inotify)
+	# or after `settle` seconds without change
+	pending = {}
+	def touched( file, closed = False ):
+		state = pending.setdefault( file, [ None, time.monotonic(), closed ] )
+		state[ 2 ] = closed
+
+	saved = time.monotonic()
+	while not stopevent.is_set():
+		if notify:
+			for path, mask in notify.read( min( interval, .1 ) if pending else interval ):
+				if path is None:
+					watched( gallery )
+					for file in scan( gallery, *options ):
+						touched( file )
+				elif mask & IN_ISDIR:
+					if mask & ( IN_CREATE | IN_MOVED_TO ):
+						watched( path )
+						for file in scan( path, None, include, exclude, skip ):
+							if selected( gallery, file, *options ):
+								touched( file )
+				elif selected( gallery, path, *options ):
+					touched( path, bool( mask & ( IN_CLOSE_WRITE | IN_MOVED_TO ) ) )
+		else:
+			stopevent.wait( interval )
+
+			for file, signature in listed():
+				if known.get( file ) != signature:
+					known[ file ] = signature
+					touched( file )
+
+		now = time.monotonic()
+		ready = []
+		for path, state in list( pending.items() ):
+			signature = stat( path )
+			if signature is None:
+				del pending[ path ]
+			elif state[ 2 ] or ( signature == state[ 0 ] and ( now - state[ 1 ] ) >= settle ):
+				ready.append( path )
+				del pending[ path ]
+			elif signature != state[ 0 ]:
+				state[ 0 ] = signature
+				state[ 1 ] = now
+
+		if ready:
+			batch.feed( ready )
+
+		if ( now - saved ) >= 30:
+			batch.save()
+			saved = now
+
+	if notify:
+		notify.close()
+	batch.close()
+
+	return ( batch )